@@ -7,9 +7,17 @@ Orchestrate the anonymisation process for Melbourne Genomics
 2) Identify what data is available to researcher
 3) Identify all patients for conditions requested, or a particular patient in a "condition"
 4) Create metadata file for patients in "condition", and edit columns accordingly. 
-5) Symbolic link to re-identifiable data, or anonymise data depending on request combination.
+5) Symbolic link (or hard link, reflink or copy, see --materialise) to
+   re-identifiable data, or anonymise data depending on request combination.
+   With --queue the files are processed by workers on other hosts, see
+   work_queue.py.
+   Applications with filter_results TRUE are restricted to the prioritised
+   genes of each sample with --gene-bed (which they require), see
+   regions.py, and get no FASTQ files.
 6) md5.txt
-7) Create upload files, and send links to requestor and PI of Application ID
+7) Create upload files (--package: tar archives and a checksum manifest),
+   upload them (--upload-bucket: S3 compatible storage), and send links to
+   requestor and PI of Application ID
 
 Usage:
 
@@ -19,7 +27,6 @@ TODO:
     - decide if we are using filtered or unfiltered VCF files
     - check if BAI files need anonymising
     - check consent
-    - file uploading
 '''
 
 from __future__ import print_function
@@ -29,15 +36,25 @@ import random
 import logging
 import string
 from argparse import ArgumentParser
-import sqlite3
-from error import print_error, ERROR_MAKE_DIR, ERROR_BAD_ALLOWED_DATA, ERROR_MD5, ERROR_RANDOMISE_ID
+from collections import namedtuple
+from functools import partial
+from error import print_error, ERROR_MAKE_DIR, ERROR_BAD_ALLOWED_DATA, ERROR_MD5, ERROR_RANDOMISE_ID, ERROR_VERIFY, ERROR_LEAK, ERROR_GENE_REGIONS
 from application import Application
-from random_id import make_random_ids, DEFAULT_USED_IDS_DATABASE
-from constants import BATCHES_DIR_NAME
-from metadata import Metadata, DEFAULT_METADATA_OUT_FILENAME
+from random_id import RandomIdAllocator, DEFAULT_USED_IDS_DATABASE
+from constants import BATCH_ID_PREFIX
+from metadata import stream_metadata, DEFAULT_METADATA_OUT_FILENAME
 from get_files import get_files, Data_filename, FileTypeException, VCF_filename, BAM_filename, BAI_filename, FASTQ_filename
 from vcf_edit import vcf_edit
 from bam_edit import bam_edit
+from read_names import add_read_name_args
+from aux_tags import add_tag_args
+from regions import add_region_args, read_gene_bed, gene_regions
+from verify import VerificationError
+from leak_scan import identifiers_from_metadata, scan_release, DEFAULT_SCAN_JOBS, LEAK_REPORT_SUFFIX
+from package import package_release, add_package_args
+from upload import upload_release, add_upload_args
+from work_queue import run_queued_jobs, DEFAULT_QUEUE_TIMEOUT, DEFAULT_QUEUE_WAIT
+from materialise import materialise, MATERIALISE_METHODS, DEFAULT_MATERIALISE, SYMLINK
 from version import program_version
 from subprocess import call
 
@@ -55,18 +72,64 @@ def parse_args():
     parser.add_argument("--metaout",
         required=False, default=DEFAULT_METADATA_OUT_FILENAME, type=str,
         help="Name of output metadatafile, defaults to {}".format(DEFAULT_METADATA_OUT_FILENAME))
-    parser.add_argument("--usedids", required=False,
-        default=DEFAULT_USED_IDS_DATABASE, type=str,
-        help="Sqlite3 databsae of previously used randomised sample ids defaults to {}".format(DEFAULT_USED_IDS_DATABASE))
     parser.add_argument("--consent", required=True, type=str,
         help="File path of consent metadata")
-    parser.add_argument("--md5", required=False, type=str, default=DEFAULT_MD5_COMMAND,
-        help="MD5 checksum command, defaults to {}".format(DEFAULT_MD5_COMMAND))
+    add_release_args(parser)
+    parser.add_argument("--queue", required=False, type=str,
+        help="Run the file jobs on workers (work_queue.py) through this work queue directory on shared storage")
+    parser.add_argument("--queue-timeout", required=False, type=float, default=DEFAULT_QUEUE_TIMEOUT,
+        help="Seconds without a heartbeat after which a queued job is run again, defaults to {}".format(DEFAULT_QUEUE_TIMEOUT))
+    parser.add_argument("--queue-wait", required=False, type=float, default=DEFAULT_QUEUE_WAIT,
+        help="Seconds to wait for a worker to run any queued job before giving up, defaults to {}".format(DEFAULT_QUEUE_WAIT))
     parser.add_argument('--log', metavar='FILE', type=str,
         help='Log progress in FILENAME, defaults to stdout')
     return parser.parse_args() 
 
 
+def add_release_args(parser):
+    '''Options for anonymising, checking, packaging and uploading releases,
+    shared with batch.py and daemon.py, see run_release_stages'''
+    parser.add_argument("--usedids", required=False,
+        default=DEFAULT_USED_IDS_DATABASE, type=str,
+        help="Sqlite3 database of previously used randomised sample ids defaults to {}".format(DEFAULT_USED_IDS_DATABASE))
+    parser.add_argument("--md5", required=False, type=str, default=DEFAULT_MD5_COMMAND,
+        help="MD5 checksum command, defaults to {}".format(DEFAULT_MD5_COMMAND))
+    parser.add_argument("--materialise", required=False, type=str,
+        choices=MATERIALISE_METHODS, default=DEFAULT_MATERIALISE,
+        help="How to place files which are not edited in the output directory, falling back per file to the next cheapest method, defaults to {}".format(DEFAULT_MATERIALISE))
+    parser.add_argument("--verify", required=False, action="store_true",
+        help="Verify anonymised BAM and VCF files while writing them, reporting in FILE.verify next to FILE.md5")
+    add_read_name_args(parser)
+    add_tag_args(parser)
+    add_region_args(parser)
+    parser.add_argument("--leak-scan", required=False, action="store_true",
+        help="Scan the outputs of anonymised releases for original identifiers before packaging or uploading, stopping if any are found")
+    parser.add_argument("--leak-scan-jobs", required=False, type=int, default=DEFAULT_SCAN_JOBS,
+        help="Number of files to scan in parallel, defaults to {}".format(DEFAULT_SCAN_JOBS))
+    parser.add_argument("--package", required=False, action="store_true",
+        help="Package each application directory into tar archives with a checksum manifest")
+    add_package_args(parser, "package-")
+    parser.add_argument("--upload-bucket", required=False, type=str,
+        help="Upload each application directory to this S3 compatible bucket")
+    add_upload_args(parser, "upload-")
+
+
+def editor_options(args):
+    '''Keyword arguments for the BAM and VCF editors from the command line'''
+    return { 'verify': args.verify }
+
+
+def bam_editor_options(args):
+    '''Keyword arguments for the BAM editor only, from the command line'''
+    return { 'renumber_reads': args.renumber_reads, 'max_read_names': args.max_read_names,
+        'keep_tags': args.keep_tags, 'drop_tags': args.drop_tags }
+
+
+def load_gene_bed(args):
+    '''The gene regions from --gene-bed, or None'''
+    return None if args.gene_bed is None else read_gene_bed(args.gene_bed)
+
+
 # Assumes application JSON is validated
 def create_app_dir(application):
     path = os.path.join(application.fields['application id'], application.fields['request id'])
@@ -79,19 +142,89 @@ def create_app_dir(application):
     return path
 
 
-def link_files(application_dir, filepaths):
-    output_files = []
+# A unit of work producing one output file. If editor is None the input
+# is materialised at the output (see materialise.py), otherwise
+# editor(substitutions, input, output, **editor_options) writes an
+# anonymised copy, replacing every old identifier in the substitutions
+# mapping with its new value. Jobs are independent of each other, so they can be run
+# in any order, or in parallel.
+FileJob = namedtuple("FileJob", ["editor", "substitutions", "input", "output", "materialise", "editor_options"])
+
+
+def run_file_job(job):
+    if job.editor is not None:
+        job.editor(job.substitutions, job.input, job.output, **job.editor_options)
+        logging.info("Anonymised {} to {}".format(job.input, job.output))
+    else:
+        method = materialise(job.materialise, job.input, job.output)
+        if method == SYMLINK:
+            logging.info("Linked {} to {}".format(job.output, job.input))
+        else:
+            logging.info("Materialised {} from {} by {}".format(job.output, job.input, method))
+    return job.output
+
+
+class JobExit(Exception):
+    '''A job run in a worker process tried to exit the program'''
+
+    def __init__(self, code, job):
+        Exception.__init__(self, code, job)
+        self.code = code
+        self.job = job
+
+    def __str__(self):
+        return "job for {} exited with status {}".format(self.job, self.code)
+
+
+def run_in_worker(function, argument):
+    '''Run function(argument) in a multiprocessing pool worker. Jobs report
+    errors by exiting the program, which would kill the worker and leave the
+    pool waiting for a result forever, so the exit is raised in the parent
+    process as a JobExit instead.'''
+    try:
+        return function(argument)
+    except SystemExit as e:
+        raise JobExit(e.code, str(getattr(argument, 'output', argument)))
+
+
+def plan_link_files(application_dir, filepaths, method=DEFAULT_MATERIALISE):
+    jobs = []
     for path in filepaths:
         _, filename = os.path.split(path)
         link_name = os.path.join(application_dir, filename)
-        output_files.append(link_name)
-        os.symlink(path, link_name)
-    return output_files
+        jobs.append(FileJob(None, None, path, link_name, method, {}))
+    return jobs
+
+
+def link_files(application_dir, filepaths, method=DEFAULT_MATERIALISE):
+    return [run_file_job(job) for job in plan_link_files(application_dir, filepaths, method)]
+
 
+def random_batch_id():
+    return ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(5))
 
-def anonymise_files(filenames: list[str], randomised_ids: list[str], application_dir: str, filename_type: Data_filename, file_editor=None):
-    output_files = []
-    randomised_batch_ids = {}
+
+def randomise_batch_ids(batches):
+    '''New batch IDs for the batches of a release, keyed by the old batch ID
+    as it appears in file names and BAM read groups, e.g. AGRF_024'''
+    return { BATCH_ID_PREFIX + batch: random_batch_id() for batch in sorted(batches) }
+
+
+def plan_anonymise_files(filenames: list[str], randomised_ids: list[str], application_dir: str, filename_type: Data_filename, file_editor=None, method: str=DEFAULT_MATERIALISE, editor_options: dict=None, randomised_batch_ids: dict=None, file_options=None):
+    '''file_options(old_id, new_path), if given, returns further editor
+    options for each file'''
+    jobs = []
+    if randomised_batch_ids is None:
+        randomised_batch_ids = {}
+    # Every sample and batch of the release is replaced in every edited
+    # file, so that files containing several samples (merged BAMs, trio
+    # VCFs) are anonymised in one pass. Flowcells are not replaced: FASTQs
+    # are released unedited, with the flowcell in their names and reads, and
+    # the leak scan (leak_scan.py) does not look for them either.
+    release_substitutions = None
+    if file_editor is not None:
+        release_substitutions = { str(old_id): str(new_id) for old_id, new_id in randomised_ids.items() }
+        release_substitutions.update(randomised_batch_ids)
 
     for file_path in filenames:
         try:
@@ -111,31 +244,203 @@ def anonymise_files(filenames: list[str], randomised_ids: list[str], application
 
             # Replace batch id AGRF_024 with XXXXX
             # Example filename: 010108101_AGRF_024_HG3JKBCXX_CGTACTAG_L001_R1.fastq.gz
-            fields = file_handler.get_fields(file_handler.get_filename())
-
             # Example old_batch_id: AGRF_024
-            old_batch_id = fields[1] + '_' + fields[2]
+            # Only some file names contain a batch id
+            old_batch_id = file_handler.get_batch_id()
+
+            if old_batch_id is not None:
+                # Key by old_batch_id because we want to make sure the same batch id gets the same new randomised batch id
+                if old_batch_id not in randomised_batch_ids:
+                    randomised_batch_ids[old_batch_id] = random_batch_id()
 
-            # Key by old_batch_id because we want to make sure the same batch id gets the same new randomised batch id
-            if old_batch_id not in randomised_batch_ids:
-                new_batch_id = ''.join(random.choice(string.ascii_lowercase + string.digits) for x in range(5))
-                randomised_batch_ids[old_batch_id] = new_batch_id
+                # Replace AGRF_024 with XXXXX
+                file_handler.replace_batch_id(randomised_batch_ids[old_batch_id])
 
-            # Replace AGRF_024 (field 1 and 2) with XXXXX
-            file_handler.replace_field(randomised_batch_ids[old_batch_id], 1, 2)
+            substitutions = release_substitutions
+            if file_editor is not None and old_batch_id is not None and old_batch_id not in substitutions:
+                substitutions = dict(release_substitutions)
+                substitutions[old_batch_id] = randomised_batch_ids[old_batch_id]
 
             # file_handler has updated filename (attribute of this object) at this point
             new_filename = file_handler.get_filename()
             new_path = os.path.join(application_dir, new_filename)
-            output_files.append(new_path)
-            if file_editor is not None:
-                file_editor(old_id, new_id, file_path, new_path)
-                logging.info("Anonymised {} to {}".format(file_path, new_path))
-            else:
-                os.symlink(file_path, new_path)
-                logging.info("Linked {} to {}".format(new_path, file_path))
+            options = editor_options or {}
+            if file_options is not None:
+                options = dict(options, **file_options(old_id, new_path))
+            jobs.append(FileJob(file_editor, substitutions, file_path, new_path, method, options))
+
+    return jobs
+
+
+def anonymise_files(filenames: list[str], randomised_ids: list[str], application_dir: str, filename_type: Data_filename, file_editor=None, method: str=DEFAULT_MATERIALISE):
+    jobs = plan_anonymise_files(filenames, randomised_ids, application_dir, filename_type, file_editor, method)
+    return [run_file_job(job) for job in jobs]
+
 
-    return output_files
+def plan_region_files(application_dir, filenames, filename_type, file_editor, editor_options, file_options):
+    '''Jobs which restrict files to regions without anonymising them, for
+    re-identifiable releases. file_options is as for plan_anonymise_files.'''
+    jobs = []
+    for file_path in filenames:
+        try:
+            sample_id = filename_type(file_path).get_sample_id()
+        except FileTypeException:
+            continue
+        _, filename = os.path.split(file_path)
+        new_path = os.path.join(application_dir, filename)
+        options = dict(editor_options or {}, **file_options(sample_id, new_path))
+        jobs.append(FileJob(file_editor, {}, file_path, new_path, DEFAULT_MATERIALISE, options))
+    return jobs
+
+
+def bam_index_filename(bam_filename):
+    '''The index of a BAM file, named like those of the production data'''
+    return os.path.splitext(bam_filename)[0] + ".bai"
+
+
+def check_gene_bed(application, gene_bed):
+    '''Exit the program if the application must be restricted to its
+    prioritised genes, but there is no gene BED file to do it with'''
+    if application.filter_results() and gene_bed is None:
+        print_error("application {} {} has filter_results TRUE, which needs --gene-bed".format(
+            application.fields['application id'], application.fields['request id']))
+        exit(ERROR_GENE_REGIONS)
+
+
+def sample_regions(metadata, gene_bed):
+    '''Sample ID to the merged regions of its prioritised genes. Must be
+    called before the metadata is anonymised.'''
+    return { sample_id: gene_regions(genes, gene_bed)
+        for sample_id, genes in metadata.prioritised_genes().items() }
+
+
+def region_options(regions):
+    '''file_options functions restricting the VCF and BAM files of each
+    sample to its regions'''
+    def vcf_options(sample_id, output):
+        return { 'regions': regions.get(sample_id, []) }
+    def bam_options(sample_id, output):
+        return { 'regions': regions.get(sample_id, []), 'index_filename': bam_index_filename(output) }
+    return vcf_options, bam_options
+
+
+def job_outputs(jobs):
+    '''The files written by jobs, including BAM indexes'''
+    outputs = []
+    for job in jobs:
+        outputs.append(job.output)
+        if job.editor_options.get('index_filename') is not None:
+            outputs.append(job.editor_options['index_filename'])
+    return outputs
+
+
+# The data selected for a single application, before any randomised IDs are
+# assigned or output files are written
+Release = namedtuple("Release",
+    [ "application", "application_dir", "allowed_data_types", "metadata"
+    , "fastqs", "bams", "bais", "vcfs" ])
+
+
+def select_release(application, application_dir, allowed_data_types, data_dir, consent, metadata, catalog=None):
+    '''Find the consented samples and their files for an application.
+    metadata must already be restricted to the requested cohorts.'''
+    metadata_sample_ids = sorted(metadata.get_sample_ids())
+    logging.info("Metadata for sample IDs: {}".format(' '.join(metadata_sample_ids)))
+    # Filter the sample metadata based on patient consent
+    metadata.filter_consent(consent, allowed_data_types)
+    logging.warning("Consent not handled yet. FIXME")
+    # Find all the file paths for requested file types for each
+    # consented sample
+    requested_file_types = application.file_types()
+    logging.info("Requested file types: {}".format(' '.join(requested_file_types)))
+    fastqs, bams, bais, vcfs = get_files(data_dir, requested_file_types, metadata, catalog)
+    logging.info("VCF files selected:\n{}".format('\n'.join(vcfs)))
+    logging.info("BAM files selected:\n{}".format('\n'.join(bams)))
+    logging.info("BAI files selected:\n{}".format('\n'.join(bais)))
+    logging.info("FASTQ files selected:\n{}".format('\n'.join(fastqs)))
+    return Release(application, application_dir, allowed_data_types, metadata,
+        fastqs, bams, bais, vcfs)
+
+
+def plan_release(release, randomised_ids, metaout, method=DEFAULT_MATERIALISE, write_metadata=True, editor_options=None,
+        bam_editor_options=None, gene_bed=None):
+    '''Write the output metadata for a release and return the names of
+    its output files together with the jobs that will create them.
+    randomised_ids is only used for anonymised releases. Files which are
+    not edited are materialised using method, and editor_options are passed
+    to the BAM and VCF editors, followed by bam_editor_options for the BAM
+    editor. If write_metadata is False the output
+    metadata has already been written by stream_metadata.
+
+    If the application has filter_results TRUE, gene_bed (see read_gene_bed)
+    is required. The BAM and VCF files only contain the prioritised genes of
+    each sample, the BAM files are indexed again instead of materialising
+    their original indexes, and FASTQ files, which cannot be restricted to
+    genes, are not released.'''
+    application_dir = release.application_dir
+    metadata = release.metadata
+    vcf_regions = bam_regions = None
+    bais = release.bais
+    fastqs = release.fastqs
+    if release.application.filter_results():
+        check_gene_bed(release.application, gene_bed)
+        vcf_regions, bam_regions = region_options(sample_regions(metadata, gene_bed))
+        bais = []
+        if fastqs:
+            logging.warning("Not releasing {} FASTQ files for {}, they cannot be restricted to the prioritised genes".format(
+                len(fastqs), application_dir))
+            fastqs = []
+    bam_options = dict(editor_options or {}, **(bam_editor_options or {}))
+    if 'Anonymised' in release.allowed_data_types:
+        if write_metadata:
+            metadata.anonymise(randomised_ids)
+            metadata.write(metaout)
+            logging.info("Anonymised metadata written to: {}".format(metaout))
+        # the same batch gets the same new ID in file names and file contents
+        batch_ids = randomise_batch_ids(metadata.batches)
+        # BAIs and FASTQs are just linked (or copied) to output with randomised name
+        jobs = plan_anonymise_files(release.vcfs, randomised_ids, application_dir, VCF_filename, vcf_edit, editor_options=editor_options, randomised_batch_ids=batch_ids, file_options=vcf_regions) + \
+               plan_anonymise_files(release.bams, randomised_ids, application_dir, BAM_filename, bam_edit, editor_options=bam_options, randomised_batch_ids=batch_ids, file_options=bam_regions) + \
+               plan_anonymise_files(bais, randomised_ids, application_dir, BAI_filename, method=method, randomised_batch_ids=batch_ids) + \
+               plan_anonymise_files(fastqs, randomised_ids, application_dir, FASTQ_filename, method=method, randomised_batch_ids=batch_ids)
+    elif 'Re-identifiable' in release.allowed_data_types:
+        if bam_regions is None:
+            jobs = plan_link_files(application_dir, release.vcfs + release.bams + release.bais + release.fastqs, method)
+        else:
+            jobs = plan_region_files(application_dir, release.vcfs, VCF_filename, vcf_edit, editor_options, vcf_regions) + \
+                   plan_region_files(application_dir, release.bams, BAM_filename, bam_edit, bam_options, bam_regions) + \
+                   plan_link_files(application_dir, fastqs, method)
+        if write_metadata:
+            metadata.write(metaout)
+    else:
+        print_error("Allowed data is neither anonymised nor re-identifiable")
+        exit(ERROR_BAD_ALLOWED_DATA)
+    return job_outputs(jobs), jobs
+
+
+def original_identifiers(release):
+    '''The identifiers the leak scan searches the outputs of a release for.
+    They must be collected before plan_release anonymises the metadata.'''
+    return identifiers_from_metadata(release.metadata,
+        release.fastqs + release.bams + release.bais + release.vcfs)
+
+
+def check_leaks(release, metaout, jobs, identifiers=None):
+    '''Scan the release directory and the output metadata of an anonymised
+    release for original identifiers, exiting the program if any are found.
+    identifiers must be given if release.metadata has already been
+    anonymised. Re-identifiable releases contain the original identifiers
+    by design, so they are not scanned.'''
+    if 'Anonymised' not in release.allowed_data_types:
+        logging.info("Release {} is re-identifiable, not scanning for original identifiers".format(release.application_dir))
+        return
+    if identifiers is None:
+        identifiers = original_identifiers(release)
+    logging.info("Scanning outputs for {} original identifiers".format(len(identifiers)))
+    if scan_release(release.application_dir, identifiers, [metaout], jobs) > 0:
+        print_error("original identifiers found in the output of {}, see {}".format(
+            release.application_dir, os.path.normpath(release.application_dir) + LEAK_REPORT_SUFFIX))
+        exit(ERROR_LEAK)
 
 
 def init_log(log_file):
@@ -152,15 +457,80 @@ def init_log(log_file):
 
 def md5_files(md5_command, filenames):
     for filename in filenames:
-        output_filename = filename + ".md5"
-        logging.info("{} {} > {}".format(md5_command, filename, output_filename))
-        with open(output_filename, "w") as out_file:
-            try:
-                command = md5_command.split() + [filename]
-                call(command, stdout=out_file)
-            except OSError as e:
-                print_error(e)
-                exit(ERROR_MD5)
+        md5_file(md5_command, filename)
+
+
+def map_jobs(pool, function, arguments):
+    '''Apply function to each argument, on pool in any order, or in this
+    process if pool is None'''
+    if pool is None:
+        return map(function, arguments)
+    return pool.imap_unordered(partial(run_in_worker, function), arguments)
+
+
+def run_release_stages(args, releases, jobs, output_files, pool=None, stage=None, job_finished=None):
+    '''Run the planned file jobs of releases (see plan_release), checksum
+    their output_files, and then, as args asks (see add_release_args), scan
+    the outputs for original identifiers, package and upload each release.
+    releases are (release, metaout, identifiers) triples, with the original
+    identifiers of the release (see original_identifiers). Jobs and
+    checksums run on pool, or in this process if pool is None. stage is
+    called with the name of each stage as it starts, and job_finished with
+    the output of each file job. Errors exit the program.'''
+    stage = stage or (lambda name: None)
+    try:
+        stage("anonymising")
+        for output in map_jobs(pool, run_file_job, jobs):
+            logging.info("Finished {}".format(output))
+            if job_finished is not None:
+                job_finished(output)
+        stage("md5")
+        if output_files:
+            logging.info("Generating MD5 checksums on output files")
+        for _ in map_jobs(pool, partial(md5_file, args.md5), output_files):
+            pass
+    except VerificationError as e:
+        print_error(e)
+        exit(ERROR_VERIFY)
+    except JobExit as e:
+        print_error(e)
+        exit(e.code)
+    if args.leak_scan:
+        stage("leak scan")
+        for release, metaout, identifiers in releases:
+            check_leaks(release, metaout, args.leak_scan_jobs, identifiers)
+    if args.package:
+        stage("packaging")
+        for release, _metaout, _identifiers in releases:
+            package_release(release.application_dir, part_size=args.package_part_size,
+                compress=args.package_compress, jobs=args.package_jobs)
+    if args.upload_bucket is not None:
+        stage("uploading")
+        for release, _metaout, _identifiers in releases:
+            upload_release(release.application_dir, args.upload_bucket, args.upload_prefix,
+                args.upload_endpoint, args.upload_jobs, args.upload_part_size)
+
+
+def has_current_md5(filename):
+    '''True if filename has a non-empty .md5 file, written after it'''
+    try:
+        md5_stat = os.stat(filename + ".md5")
+    except OSError:
+        return False
+    return md5_stat.st_size > 0 and md5_stat.st_mtime >= os.stat(filename).st_mtime
+
+
+def md5_file(md5_command, filename):
+    output_filename = filename + ".md5"
+    logging.info("{} {} > {}".format(md5_command, filename, output_filename))
+    with open(output_filename, "w") as out_file:
+        try:
+            command = md5_command.split() + [filename]
+            call(command, stdout=out_file)
+        except OSError as e:
+            print_error(e)
+            exit(ERROR_MD5)
+    return output_filename
 
 
 def main():
@@ -170,55 +540,50 @@ def main():
         # parse and validate the requested data application JSON file
         application = Application(app_file) 
         logging.info("Input data application parsed: {}".format(args.app))
+        gene_bed = load_gene_bed(args)
+        check_gene_bed(application, gene_bed)
         # Create output directory for the results
         application_dir = create_app_dir(application)
         # check what data types are allowed for this application
         allowed_data_types = application.allowed_data_types()
         logging.info("Allowed data types: {}".format(' '.join(allowed_data_types)))
         if len(allowed_data_types) > 0:
-            # Get all the sample metadata for all requested cohorts
+            # Stream the sample metadata for all requested cohorts to the
+            # output, generating random IDs for all output samples on the
+            # way if the release is anonymised
             requested_cohorts = application.cohorts()
-            metadata = Metadata(args.data, requested_cohorts)
+            allocator = None
+            randomised_ids = None
+            if 'Anonymised' in allowed_data_types:
+                allocator = RandomIdAllocator(args.usedids)
+            metadata = stream_metadata(args.data, requested_cohorts, args.metaout,
+                None if allocator is None else allocator.get)
             logging.info("Metadata collected for requested cohorts: {}".format(' '.join(requested_cohorts)))
-            metadata_sample_ids = sorted(metadata.get_sample_ids())
-            logging.info("Metadata for sample IDs: {}".format(' '.join(metadata_sample_ids)))
-            # Filter the sample metadata based on patient consent
-            metadata.filter_consent(args.consent, allowed_data_types)
-            logging.warning("Consent not handled yet. FIXME")
-            # Find all the file paths for requested file types for each
-            # consented sample
-            requested_file_types = application.file_types()
-            logging.info("Requested file types: {}".format(' '.join(requested_file_types)))
-            fastqs, bams, bais, vcfs = get_files(args.data, requested_file_types, metadata)
-            logging.info("VCF files selected:\n{}".format('\n'.join(vcfs)))
-            logging.info("BAM files selected:\n{}".format('\n'.join(bams)))
-            logging.info("BAI files selected:\n{}".format('\n'.join(bais)))
-            logging.info("FASTQ files selected:\n{}".format('\n'.join(fastqs)))
-            output_files = []
+            logging.info("Metadata written to: {}".format(args.metaout))
+            if allocator is not None:
+                allocator.commit()
+                allocator.close()
+                randomised_ids = allocator.ids
+            release = select_release(application, application_dir, allowed_data_types,
+                args.data, args.consent, metadata)
+            identifiers = original_identifiers(release)
+            output_files, jobs = plan_release(release, randomised_ids, args.metaout,
+                args.materialise, write_metadata=False, editor_options=editor_options(args),
+                bam_editor_options=bam_editor_options(args), gene_bed=gene_bed)
             if 'Anonymised' in allowed_data_types:
-                # generate random IDs for all output samples
-                randomised_ids = make_random_ids(args.usedids, metadata.sample_ids)
-                metadata.anonymise(randomised_ids)
-                metadata.write(args.metaout)
-                logging.info("Anonymised metadata written to: {}".format(args.metaout))
-                new_vcfs = anonymise_files(vcfs, randomised_ids, application_dir, VCF_filename, vcf_edit)
-                new_bams = anonymise_files(bams, randomised_ids, application_dir, BAM_filename, bam_edit)
-                # BAIs and FASTQs are just sym-linked to output with randomised name
-                new_bais = anonymise_files(bais, randomised_ids, application_dir, BAI_filename)
-                new_fastqs = anonymise_files(fastqs, randomised_ids, application_dir, FASTQ_filename)
-                output_files.extend(new_vcfs + new_bams + new_bais + new_fastqs)
                 logging.info("Output files are anonymised")
-            elif 'Re-identifiable' in allowed_data_types:
-                new_links = link_files(application_dir, vcfs + bams + bais + fastqs)
-                output_files.extend(new_links)
+            else:
                 logging.info("Files linked in directory: {}".format(application_dir))
-                metadata.write(args.metaout)
                 logging.info("Output files are re-identifiable")
-            else:
-                print_error("Allowed data is neither anonymised nor re-identifiable")
-                exit(ERROR_BAD_ALLOWED_DATA)
-            logging.info("Generating MD5 checksums on output files")
-            md5_files(args.md5, output_files)
+            if args.queue is not None:
+                # the workers also checksum the outputs
+                run_queued_jobs(args.queue, jobs, args.md5, args.queue_timeout, wait=args.queue_wait)
+                logging.info("Checking the MD5 checksum files written by the workers")
+                jobs = []
+                output_files = [filename for filename in output_files if not has_current_md5(filename)]
+                if output_files:
+                    logging.warning("Generating {} MD5 checksums missing from the workers' output".format(len(output_files)))
+            run_release_stages(args, [(release, args.metaout, identifiers)], jobs, output_files)
         else:
             logging.warning("No data available for this application")
         
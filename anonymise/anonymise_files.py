@@ -1,48 +1,131 @@
 import os
 import argparse
-import pymongo
-import glob
+import logging
 import random
 import string
 
 from pymongo import MongoClient
 
-from random_id import make_random_ids
+from random_id import make_random_id_groups
 from anon import anonymise_files
-from get_files import get_files, FileTypeException, VCF_filename, BAM_filename, BAI_filename, FASTQ_filename, FASTQ_SUFFIX
+from materialise import MATERIALISE_METHODS, DEFAULT_MATERIALISE
+from get_files import FileTypeException, FASTQ_filename
+
+
+DEFAULT_MONGO_HOST = 'localhost'
+DEFAULT_MONGO_PORT = 27017
+DEFAULT_USED_IDS_DATABASE = 'used_random_sample_ids.db'
+
+# One client per server for the life of the process. MongoClient keeps its
+# own connection pool, so every query shares the same connections.
+MONGO_CLIENTS = {}
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Copy files and randomize their names')
-    parser.add_argument('--request-id',  metavar='data_request_id', type=str, required=True,
+    parser.add_argument('--request-id',  metavar='data_request_id', type=str,
                         help='Data request id generated by Data Access and Release website')
-    parser.add_argument('--flagship', metavar='flagship_code', type=str, required=True,
+    parser.add_argument('--flagship', metavar='flagship_code', type=str,
                         help='Flagship code')
+    parser.add_argument('--requests', metavar='requests_file', type=str,
+                        help='Tab separated file of data request id and flagship code pairs, one per line. '
+                             'Files for each pair are released into release_directory/data_request_id/flagship_code')
     parser.add_argument('--data-dir', metavar='source_data_directory', type=str, required=True,
                         help='Full path to the directory')
     parser.add_argument('--release-dir', metavar='release_directory', type=str, required=True,
                         help='Full path to the directory')
+    parser.add_argument('--materialise', type=str, choices=MATERIALISE_METHODS, default=DEFAULT_MATERIALISE,
+                        help='How to place FASTQ files in the release directory, defaults to {}'.format(DEFAULT_MATERIALISE))
+    parser.add_argument('--mongo-host', type=str, default=DEFAULT_MONGO_HOST,
+                        help='MongoDB host, defaults to {}'.format(DEFAULT_MONGO_HOST))
+    parser.add_argument('--mongo-port', type=int, default=DEFAULT_MONGO_PORT,
+                        help='MongoDB port, defaults to {}'.format(DEFAULT_MONGO_PORT))
 
-    return parser.parse_args()
+    options = parser.parse_args()
+    if options.requests is None and (options.request_id is None or options.flagship is None):
+        parser.error('either --requests or both --request-id and --flagship are required')
+    return options
 
 
-def init_db():
-    conn = MongoClient('localhost', 27017)
-    db = conn.data_access
+def init_db(host=DEFAULT_MONGO_HOST, port=DEFAULT_MONGO_PORT):
+    if (host, port) not in MONGO_CLIENTS:
+        MONGO_CLIENTS[(host, port)] = MongoClient(host, port)
+    db = MONGO_CLIENTS[(host, port)].data_access
 
     return db
 
-def get_samples(request_id, flagship):
+def get_samples(request_id, flagship, db=None):
     """
     Find all the samples from this flagship to be released for this data request
 
     """
-    db = init_db()
-    samples = db.data_requests.find(filter={'flagship_id': flagship, 'data_request_id': request_id},
-                                    projection=['flagship_id', 'lab_sample_id', 'batch_no'])
+    return get_samples_bulk([(request_id, flagship)], db)[(request_id, flagship)]
+
+def get_samples_bulk(requests, db=None):
+    """
+    Find the samples for many (request_id, flagship) pairs in a single query.
+
+    Returns a dictionary mapping each pair to its list of samples. Any database
+    with a pymongo compatible interface can be passed as db, for example a
+    mongomock stand-in.
 
+    """
+    if db is None:
+        db = init_db()
+    result = {(request_id, flagship): [] for request_id, flagship in requests}
+    if not result:
+        return result
+    query = {'$or': [{'flagship_id': flagship, 'data_request_id': request_id}
+                     for request_id, flagship in result]}
+    samples = db.data_requests.find(filter=query,
+                                    projection=['flagship_id', 'data_request_id', 'lab_sample_id', 'batch_no'])
+    for sample in samples:
+        result[(sample['data_request_id'], sample['flagship_id'])].append(sample)
+
+    return result
+
+def index_fastq_files(data_dir, batch_nos):
+    """
+    List each batch directory once, and index its FASTQ files by sample ID
+
+    Returns a dictionary mapping batch number to a dictionary from lab sample
+    ID to the sorted list of FASTQ file paths for that sample.
+
+    """
+    index = {}
+    for batch_no in set(batch_nos):
+        batch_dir = os.path.join(data_dir, batch_no)
+        batch_index = {}
+        try:
+            filenames = os.listdir(batch_dir)
+        except OSError:
+            filenames = []
+        for filename in sorted(filenames):
+            try:
+                file_handler = FASTQ_filename(os.path.join(batch_dir, filename))
+            except FileTypeException:
+                continue
+            batch_index.setdefault(file_handler.get_sample_id(), []).append(file_handler.absolute_path)
+        index[batch_no] = batch_index
+
+    return index
+
+def find_fastq_files(samples, index):
+    """
+    Resolve the FASTQ files for each sample from an index made by index_fastq_files
+
+    """
+    sample_ids = []
+    file_paths = []
+    for sample in samples:
+        sample_files = index.get(sample['batch_no'], {}).get(sample['lab_sample_id'], [])
+        if sample_files:
+            sample_ids.append(sample['lab_sample_id'])
+            file_paths += sample_files
+        else:
+            logging.warning('No FASTQ file found for sample ' + sample['lab_sample_id'])
 
-    return [sample for sample in samples]
+    return sample_ids, file_paths
 
 def get_new_batch_ids(samples):
     """
@@ -64,6 +147,21 @@ def get_new_batch_ids(samples):
     return new_batch_ids
 
 
+def read_requests(requests_filename):
+    """
+    Read (request_id, flagship) pairs from a tab separated file
+
+    """
+    requests = []
+    with open(requests_filename) as requests_file:
+        for line in requests_file:
+            fields = line.split()
+            if fields:
+                requests.append((fields[0], fields[1]))
+
+    return requests
+
+
 def anonymise_fastq_files():
     """
     Anonymise FASTQ files data request per flagship
@@ -73,23 +171,40 @@ def anonymise_fastq_files():
 
     data_dir = options.data_dir
     release_dir = options.release_dir
-    flagship = options.flagship
-    request_id = options.request_id
+    db = init_db(options.mongo_host, options.mongo_port)
 
-    sample_ids = []
-    file_paths = []
-    samples = get_samples(request_id, flagship)
-    for sample in samples:
-        batch_dir = os.path.join(data_dir, sample['batch_no'], sample['lab_sample_id'])
-        sample_files = glob.glob(batch_dir + '*' + FASTQ_SUFFIX)
-        if sample_files:
-            sample_ids.append(sample['lab_sample_id'])
-            file_paths += sample_files
-        else:
-            print('WARNING: No FASTQ file found for sample ' + sample['lab_sample_id'])
+    if options.requests is None:
+        requests = [(options.request_id, options.flagship)]
+        release_dirs = {requests[0]: release_dir}
+    else:
+        requests = read_requests(options.requests)
+        release_dirs = {(request_id, flagship): os.path.join(release_dir, request_id, flagship)
+                        for request_id, flagship in requests}
 
-    randomised_ids = make_random_ids('used_random_sample_ids.db', sample_ids)
-    randomised_files = anonymise_files(file_paths, randomised_ids, release_dir, FASTQ_filename)
+    return anonymise_fastq_files_bulk(requests, data_dir, release_dirs, db, method=options.materialise)
+
+
+def anonymise_fastq_files_bulk(requests, data_dir, release_dirs, db=None,
+                               used_ids_database=DEFAULT_USED_IDS_DATABASE, method=DEFAULT_MATERIALISE):
+    """
+    Anonymise the FASTQ files of many data requests, fetching the samples in one
+    query, listing each batch directory once and allocating all the random
+    sample IDs in one transaction
+
+    """
+    samples = get_samples_bulk(requests, db)
+    index = index_fastq_files(data_dir, [sample['batch_no']
+                                         for request in requests for sample in samples[request]])
+
+    found = [find_fastq_files(samples[request], index) for request in requests]
+    id_groups = make_random_id_groups(used_ids_database, [sample_ids for sample_ids, _paths in found])
+
+    randomised_files = []
+    for request, (_sample_ids, file_paths), randomised_ids in zip(requests, found, id_groups):
+        request_release_dir = release_dirs[request]
+        if not os.path.isdir(request_release_dir):
+            os.makedirs(request_release_dir)
+        randomised_files += anonymise_files(file_paths, randomised_ids, request_release_dir, FASTQ_filename, method=method)
 
     return randomised_files
 
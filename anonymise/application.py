@@ -10,8 +10,11 @@ from __future__ import print_function
 import json
 import os
 import sys
-from jsonschema import validate, ValidationError
-from pkg_resources import resource_filename
+import hashlib
+from functools import lru_cache
+from importlib.metadata import version, PackageNotFoundError
+from importlib import resources
+from pathlib import Path
 from collections import namedtuple
 from program_name import PROGRAM_NAME
 from error import print_error, ERROR_JSON_SCHEMA_DEFINE, \
@@ -21,35 +24,24 @@ from error import print_error, ERROR_JSON_SCHEMA_DEFINE, \
 JSON_SCHEMA = "application_json_schema.txt"
 FILE_TYPES = ["fastq", "bam", "vcf"]
 COHORTS = ["AML", "EPIL", "CS", "CRC", "CMT"]
+# If this environment variable names a directory, applications which
+# passed validation are remembered there (by a hash of the jsonschema
+# version, the schema and the application), so that validating them again
+# does not need to import jsonschema at all. Off by default.
+VALIDATION_CACHE_VARIABLE = "ANONYMISE_VALIDATION_CACHE"
 
 class Application(object):
 
-    def __init__ (self, filename):
-        fields = json.load(filename)
+    def __init__ (self, filename, fields=None):
+        # fields can be supplied already parsed, for example when reading
+        # many applications from a JSON lines stream
+        if fields is None:
+            fields = json.load(filename)
  
         # Validate input JSON file against schema. This function exits the program if
         # the validation fails, otherwise we return a dictionary representing
         # the JSON file
-        try:
-            json_schema_filename = resource_filename(PROGRAM_NAME, os.path.join('data', JSON_SCHEMA))
-        except Exception as e:
-            print_error("JSON schema file not defined, program not installed correctly")
-            exit(ERROR_JSON_SCHEMA_DEFINE)
-        try:
-            json_schema_file = open(json_schema_filename)
-            json_schema = json.load(json_schema_file)
-        except OSError as e:
-            print_error("Cannot open JSON schema file: {}".format(json_schema_filename))
-            print_error(str(e), file=sys.stderr)
-            exit(ERROR_JSON_SCHEMA_OPEN)
-        finally:
-            json_schema_file.close()
-        try:
-            validate(fields, json_schema)
-        except ValidationError as e:
-            print_error("JSON input file is not valid: {}".format(filename))
-            print(e, file=sys.stderr)
-            exit(ERROR_JSON_SCHEMA_INVALID)
+        validate_application(fields, filename)
 
         # We only reach here if everything succeeded
         self.fields = fields 
@@ -80,6 +72,85 @@ class Application(object):
         '''Return a list of all the file types requested in an application'''
         return [file_type for file_type in FILE_TYPES if self.fields["file types"][file_type] == "TRUE"]
 
+    def filter_results(self):
+        '''True if the results must be restricted to the prioritised genes
+        of each sample'''
+        return self.fields["filter_results"] == "TRUE"
+
+
+@lru_cache(maxsize=None)
+def json_schema_text():
+    '''The text of the application JSON schema, read once per process'''
+    try:
+        schema_resource = resources.files(PROGRAM_NAME).joinpath('data').joinpath(JSON_SCHEMA)
+    except ImportError:
+        # Running from a source checkout, look next to this file instead
+        schema_resource = Path(__file__).resolve().parent.joinpath('data', JSON_SCHEMA)
+    if not schema_resource.is_file():
+        print_error("JSON schema file not defined, program not installed correctly")
+        exit(ERROR_JSON_SCHEMA_DEFINE)
+    try:
+        return schema_resource.read_text()
+    except OSError as e:
+        print_error("Cannot open JSON schema file: {}".format(schema_resource))
+        print(e, file=sys.stderr)
+        exit(ERROR_JSON_SCHEMA_OPEN)
+
+
+@lru_cache(maxsize=None)
+def application_validator():
+    '''The application JSON schema compiled into a validator, built (and
+    the schema itself checked) once per process'''
+    from jsonschema import SchemaError
+    from jsonschema.validators import validator_for
+    json_schema = json.loads(json_schema_text())
+    validator_class = validator_for(json_schema)
+    try:
+        validator_class.check_schema(json_schema)
+    except SchemaError as e:
+        print_error("JSON schema file is not a valid schema, program not installed correctly")
+        print(e, file=sys.stderr)
+        exit(ERROR_JSON_SCHEMA_DEFINE)
+    return validator_class(json_schema)
+
+
+def validation_cache_filename(fields):
+    '''The file marking fields as valid in the validation cache, or None if
+    the cache is not enabled'''
+    cache_dir = os.environ.get(VALIDATION_CACHE_VARIABLE)
+    if not cache_dir:
+        return None
+    try:
+        jsonschema_version = version("jsonschema")
+    except PackageNotFoundError:
+        return None
+    digest = hashlib.sha1(jsonschema_version.encode('utf-8'))
+    digest.update(json_schema_text().encode('utf-8'))
+    digest.update(json.dumps(fields, sort_keys=True).encode('utf-8'))
+    return os.path.join(cache_dir, digest.hexdigest())
+
+
+def validate_application(fields, filename):
+    '''Exit the program if fields is not a valid application'''
+    cache_filename = validation_cache_filename(fields)
+    if cache_filename is not None and os.path.exists(cache_filename):
+        return
+    from jsonschema import ValidationError
+    try:
+        application_validator().validate(fields)
+    except ValidationError as e:
+        print_error("JSON input file is not valid: {}".format(filename))
+        print(e, file=sys.stderr)
+        exit(ERROR_JSON_SCHEMA_INVALID)
+    if cache_filename is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        open(cache_filename, 'w').close()
+    except OSError:
+        # the cache is only an optimisation
+        pass
+
 
 def application_to_request(application):
     return Request(ethics=application['ethics'],
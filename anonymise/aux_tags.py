@@ -0,0 +1,78 @@
+'''
+Remove optional (auxiliary) tags from BAM records.
+
+Recalibrated BAM files carry tags researchers rarely need, such as the
+original base qualities (OQ), BD/BI indel qualities and aligner specific
+tags, which can double the size of a file. The BAM editor can remove them
+while it rewrites each record:
+
+    - with a deny list (--drop-tags OQ,BD,BI), the listed tags are removed
+    - with an allow list (--keep-tags NM,MD,SA), all other tags are removed.
+      RG is always kept, because the header refers to it.
+
+The bytes saved for each tag are counted with the size of the tag in the
+BAM record encoding (before compression), and logged when the file is
+finished.
+'''
+
+import logging
+
+ALWAYS_KEPT_TAGS = ['RG']
+# bytes of one value of each fixed size BAM tag type
+TAG_TYPE_SIZES = { 'A': 1, 'c': 1, 'C': 1, 's': 2, 'S': 2, 'i': 4, 'I': 4, 'f': 4 }
+# tag name and type code
+TAG_HEADER_SIZE = 3
+
+
+def add_tag_args(parser):
+    '''Tag removal options, shared by the programs which call bam_edit'''
+    tags = parser.add_mutually_exclusive_group()
+    tags.add_argument("--drop-tags", required=False, type=parse_tags,
+        help="Comma separated BAM tags to remove, e.g. OQ,BD,BI")
+    tags.add_argument("--keep-tags", required=False, type=parse_tags,
+        help="Comma separated BAM tags to keep, removing all others except {}".format(','.join(ALWAYS_KEPT_TAGS)))
+
+
+def parse_tags(text):
+    return [tag.strip() for tag in text.split(',') if tag.strip()]
+
+
+def tag_size(value, value_type):
+    '''Bytes used by a tag in a BAM record'''
+    if value_type in TAG_TYPE_SIZES:
+        return TAG_HEADER_SIZE + TAG_TYPE_SIZES[value_type]
+    if value_type == 'B':
+        # element type, count, then the elements
+        # pysam returns arrays, which know their element size
+        return TAG_HEADER_SIZE + 1 + 4 + len(value) * getattr(value, 'itemsize', 4)
+    # Z and H: NUL terminated text
+    return TAG_HEADER_SIZE + len(value) + 1
+
+
+class TagFilter(object):
+    '''Removes tags from pysam AlignedSegments, counting the bytes saved'''
+
+    def __init__(self, keep=None, drop=None):
+        self.keep = None if keep is None else set(keep) | set(ALWAYS_KEPT_TAGS)
+        self.drop = [] if drop is None else list(drop)
+        # tag -> [records, bytes]
+        self.removed = {}
+
+    def strip(self, read):
+        if self.keep is not None:
+            candidates = [tag for tag, _value in read.get_tags() if tag not in self.keep]
+        else:
+            candidates = [tag for tag in self.drop if read.has_tag(tag)]
+        for tag in candidates:
+            value, value_type = read.get_tag(tag, with_value_type=True)
+            removed = self.removed.setdefault(tag, [0, 0])
+            removed[0] += 1
+            removed[1] += tag_size(value, value_type)
+            read.set_tag(tag, None)
+
+    def finish(self, filename):
+        total = 0
+        for tag, (records, size) in sorted(self.removed.items()):
+            logging.info("Removed tag {} from {} records of {}, saving {} bytes".format(tag, records, filename, size))
+            total += size
+        logging.info("Removed {} bytes of tags from {}".format(total, filename))
@@ -4,58 +4,201 @@
 Replace text in a BAM file in certain fields for the purposes
 of anonymisation.
 
-Replaces --old with --new in the following places:
+Replaces each --old with the matching --new (or each pair in the --map
+file, see substitute.py) in the following places, in a single pass over the
+file:
 
-    - BAM header read group (RG) field
+    - BAM header read group (RG) and program (PG) fields, and comment (CO)
+      lines
     - Each alignment record in the body:
-        - the query name
+        - the query name (or, with --renumber-reads, the query name is
+          replaced by a sequential number, see read_names.py)
         - the RG field in tags
 
+Optionally tags are removed from every record in the same pass, either
+those listed with --drop-tags, or all but those listed with --keep-tags (see
+aux_tags.py).
+
+With --regions, only the reads overlapping the regions in a BED file are
+read (using the index of the input) and written, see regions.py.
+
+With --verify, record counts, header line counts and a checksum of every
+record's sequence and base qualities are compared between input and output
+as the file is written, and reported in output.verify (see verify.py).
+
+--input and --output may be "-" for standard input and output, so the
+editor can be a stage in a pipe. Standard output is uncompressed BAM, or
+SAM with --sam. For in-process pipelines, edit_bam_header and
+edit_bam_records take and yield pysam objects.
+
 Usage:
 
-    bam_edit.py --old oldtext --new newtext --input example_input.bam --output example_output.bam 
+    bam_edit.py --old oldtext --new newtext [--old oldtext2 --new newtext2 ...] --input example_input.bam --output example_output.bam [--verify]
+    bam_edit.py --map substitutions.tsv --input example_input.bam --output example_output.bam [--verify]
+    samtools view -u -h example_input.bam chr1 | bam_edit.py --map substitutions.tsv --input - --output - | samtools sort -o example_output.bam
 
 Authors: Bernie Pope, Gayle Philip
 
 '''
 
-import pysam
-
+import os
 from argparse import ArgumentParser
+from verify import Verification
+from constants import STANDARD_STREAM
+from substitute import as_substitution, add_substitution_args, substitutions_from_args
+from read_names import ReadNameMap, add_read_name_args, DEFAULT_MAX_READ_NAMES
+from aux_tags import TagFilter, add_tag_args
+from regions import read_bed, merge_regions, fetch_regions
+
+# header records whose fields are edited, see edit_bam_header
+EDITED_HEADER_RECORDS = ['RG', 'PG']
 
 def parse_args():
     """Replace old text in a BAM file"""
     parser = ArgumentParser(description="Edit reads in a BAM file")
-    parser.add_argument("--old", required=True, type=str, help="old string (to be replaced)")
-    parser.add_argument("--new", required=True, type=str, help="new string (to replace old)")
-    parser.add_argument("--output", required=True, type=str, help="output BAM file path")
-    parser.add_argument("--input", required=True, type=str, help="input BAM file path")
-    return parser.parse_args() 
-
-def bam_edit(old, new, input_filename, output_filename):
-    with pysam.AlignmentFile(input_filename, "r") as bam_input:
-        input_header = bam_input.header
-        # replace old with new in the ID field of RG in the header
-        if 'RG' in input_header:
-            for read_group in input_header['RG']:
-                if 'ID' in read_group:
-                    new_id = read_group['ID'].replace(old, new)
-                    read_group['ID'] = new_id
-                if 'SM' in read_group:
-                    new_sm = read_group['SM'].replace(old, new)
-                    read_group['SM'] = new_sm
-        with pysam.AlignmentFile(output_filename, "wb", header=input_header) as bam_output:
-            # replace old with new in the query name for each read
-            for read in bam_input:
-                read.query_name = read.query_name.replace(old, new)
-                if read.has_tag('RG'):
-                    new_tag = read.get_tag('RG').replace(old, new)
-                    read.set_tag('RG', new_tag)
-                bam_output.write(read)
+    add_substitution_args(parser)
+    parser.add_argument("--output", required=True, type=str,
+        help="output BAM file path, {} for standard output (uncompressed)".format(STANDARD_STREAM))
+    parser.add_argument("--input", required=True, type=str,
+        help="input BAM or SAM file path, {} for standard input".format(STANDARD_STREAM))
+    parser.add_argument("--sam", action="store_true", help="write SAM instead of BAM")
+    add_read_name_args(parser)
+    add_tag_args(parser)
+    parser.add_argument("--regions", type=str,
+        help="BED file of regions, only reads overlapping them are written (the input must be indexed)")
+    parser.add_argument("--index", type=str,
+        help="write an index of the output to this path")
+    parser.add_argument("--verify", action="store_true", help="verify the output while writing it")
+    parser.add_argument("--verify-report", type=str,
+        help="verification report path, defaults to the output path followed by .verify")
+    args = parser.parse_args()
+    if args.verify and args.output == STANDARD_STREAM and args.verify_report is None:
+        parser.error("--verify with output to {} needs --verify-report".format(STANDARD_STREAM))
+    if args.regions is not None and args.input == STANDARD_STREAM:
+        parser.error("--regions needs an indexed --input file")
+    return args, substitutions_from_args(parser, args)
+
+def bam_edit(substitutions, input_filename, output_filename, verify=False, sam=False, verify_report=None,
+        renumber_reads=False, max_read_names=DEFAULT_MAX_READ_NAMES, keep_tags=None, drop_tags=None,
+        regions=None, index_filename=None):
+    '''Replace every old identifier in the substitutions mapping with its
+    new value. Either filename may be "-" for the standard streams; BAM
+    written to standard output is uncompressed, for the next program in a
+    pipe. With renumber_reads, read names are replaced with sequential
+    numbers (see read_names.py) instead. Tags are removed from every record
+    if keep_tags or drop_tags is given (see aux_tags.py). If regions, a list
+    of BED style (chrom, start, end), is given, only the reads overlapping
+    them are read, using the index of the input, and written. If
+    index_filename is given the output is indexed.'''
+    # imported here because pysam is slow to load, and most users of this
+    # module only need it once they start writing BAM files
+    import pysam
+    substitute = as_substitution(substitutions)
+    verification = Verification(input_filename, output_filename, verify_report) if verify else None
+    read_names = ReadNameMap(max_read_names) if renumber_reads else None
+    tag_filter = TagFilter(keep_tags, drop_tags) if keep_tags is not None or drop_tags else None
+    if sam:
+        mode = "w"
+    elif output_filename == STANDARD_STREAM:
+        mode = "wbu"
+    else:
+        mode = "wb"
+    with pysam.AlignmentFile(input_filename, "r", index_filename=input_index(input_filename, regions)) as bam_input:
+        output_header = edit_bam_header(bam_input.header, substitute)
+        reads = bam_input if regions is None else bam_region_reads(bam_input, regions)
+        with pysam.AlignmentFile(output_filename, mode, header=output_header) as bam_output:
+            write = bam_output.write
+            if verification is not None:
+                reads = verification.measure_input(reads, measure_read)
+                write = verification.measure_output(write, measure_read)
+            for read in edit_bam_records(reads, substitute, read_names, tag_filter):
+                write(read)
+            if verification is not None:
+                verification.count('header_lines', header_lines(bam_input.header),
+                    header_lines(bam_output.header))
+    if index_filename is not None:
+        pysam.index(output_filename, index_filename)
+    if read_names is not None:
+        read_names.finish()
+    if tag_filter is not None:
+        tag_filter.finish(output_filename)
+    if verification is not None:
+        verification.finish()
+
+def input_index(input_filename, regions):
+    '''The index of a BAM file, for reading regions. Indexes of the
+    production data are named like the BAM file with .bai in place of .bam.'''
+    if regions is None or input_filename == STANDARD_STREAM:
+        return None
+    stem, extension = os.path.splitext(input_filename)
+    for index_filename in [stem + ".bai", input_filename + ".bai"]:
+        if os.path.exists(index_filename):
+            return index_filename
+    # let pysam look for it
+    return None
+
+def bam_region_reads(bam_input, regions):
+    '''The reads of an indexed BAM file overlapping regions, in file order'''
+    references = { name: number for number, name in enumerate(bam_input.references) }
+    in_file = [region for region in merge_regions(regions) if region[0] in references]
+    in_file.sort(key=lambda region: (references[region[0]], region[1]))
+    return fetch_regions(bam_input.fetch, in_file, lambda read: read.reference_start)
+
+def edit_bam_header(header, substitutions):
+    '''A copy of a pysam AlignmentHeader with the substitutions applied to
+    the read group (RG) and program (PG) fields, whose sample names and
+    command lines name the original files, and to comment (CO) lines'''
+    import pysam
+    substitute = as_substitution(substitutions)
+    # the header of an open file is read only, so edit a copy
+    header = header.to_dict()
+    for record_type in EDITED_HEADER_RECORDS:
+        for record in header.get(record_type, []):
+            for field, value in record.items():
+                if isinstance(value, str):
+                    record[field] = substitute(value)
+    if 'CO' in header:
+        header['CO'] = [substitute(comment) for comment in header['CO']]
+    return pysam.AlignmentHeader.from_dict(header)
+
+def edit_bam_records(reads, substitutions, read_names=None, tag_filter=None):
+    '''Apply the substitutions to the query name and RG tag of each pysam
+    AlignedSegment in reads, yielding each one once edited. Records are
+    edited in place, so this can be a stage in an in-process pipeline. If
+    read_names (a ReadNameMap) is given, query names are renumbered, and if
+    tag_filter (a TagFilter) is given, it removes tags.'''
+    substitute = as_substitution(substitutions)
+    for read in reads:
+        if read_names is not None:
+            read.query_name = read_names.rename(read)
+        else:
+            # query names are mostly distinct, so are not memoised
+            read.query_name = substitute.replace(read.query_name)
+        if tag_filter is not None:
+            tag_filter.strip(read)
+        if read.has_tag('RG'):
+            read.set_tag('RG', substitute(read.get_tag('RG')))
+        yield read
+
+def measure_read(read):
+    '''Verification measurements of a record, see verify.py'''
+    return [('records', 1), ('sequence_quality', read_sequence_quality(read))]
+
+def read_sequence_quality(read):
+    '''The bytes of a read's sequence and base qualities, for checksumming'''
+    sequence = read.query_sequence or ''
+    qualities = read.query_qualities
+    return sequence.encode('ascii') + (b'' if qualities is None else bytes(qualities))
+
+def header_lines(header):
+    return len(str(header).splitlines())
 
 def main():
-    args = parse_args()
-    bam_edit(args.old, args.new, args.input, args.output)
+    args, substitutions = parse_args()
+    regions = None if args.regions is None else read_bed(args.regions)
+    bam_edit(substitutions, args.input, args.output, args.verify, args.sam, args.verify_report,
+        args.renumber_reads, args.max_read_names, args.keep_tags, args.drop_tags,
+        regions, args.index)
 
 
 if __name__ == '__main__':
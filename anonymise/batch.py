@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+'''
+Anonymise many data applications in a single run.
+
+Running anon.py once per application re-validates the schema, re-reads
+every samples.txt, re-lists every batch directory and reopens the used IDs
+database each time. This program instead:
+
+1) Parses and validates all the applications
+2) Reads the sample metadata once, for the union of all requested cohorts
+3) Lists each batch directory at most once, shared by all applications
+4) Allocates randomised sample IDs for all anonymised applications in one
+   database transaction
+5) Runs the file jobs (and MD5 checksums) of all applications in a single
+   process pool
+6) Optionally scans the outputs for original identifiers (--leak-scan),
+   then packages (--package) and uploads (--upload-bucket) each
+   application directory
+
+Applications can be given as JSON files, directories containing JSON files,
+or JSON lines files (one application per line, "-" for stdin).
+
+The output metadata file of each application is written inside its
+application directory.
+
+Usage:
+
+    batch.py --apps requests.jsonl apps_dir/ extra.json --data DIR --consent FILE
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import logging
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from application import Application
+from random_id import make_random_id_groups
+from metadata import Metadata, DEFAULT_METADATA_OUT_FILENAME
+from get_files import FileCatalog
+from anon import create_app_dir, select_release, plan_release, run_release_stages, add_release_args, \
+    init_log, editor_options, bam_editor_options, load_gene_bed, check_gene_bed, original_identifiers
+from version import program_version
+
+DEFAULT_JOBS = 1
+APPLICATION_SUFFIX = ".json"
+APPLICATION_STREAM_SUFFIX = ".jsonl"
+
+
+def parse_args():
+    """Anonymise many data applications in a single run"""
+    parser = ArgumentParser(description="Anonymise many data applications in a single run, version {}".format(program_version))
+    parser.add_argument('--version', action='version', version='%(prog)s ' + program_version)
+    parser.add_argument("--apps", required=True, nargs='+', type=str,
+        help="Application JSON files, directories of application JSON files, or JSON lines files ('-' for stdin)")
+    parser.add_argument("--data", required=True,
+        type=str, help="Directory containing production data")
+    parser.add_argument("--metaout",
+        required=False, default=DEFAULT_METADATA_OUT_FILENAME, type=str,
+        help="Name of output metadatafile in each application directory, defaults to {}".format(DEFAULT_METADATA_OUT_FILENAME))
+    parser.add_argument("--consent", required=True, type=str,
+        help="File path of consent metadata")
+    parser.add_argument("--jobs", required=False, type=int, default=DEFAULT_JOBS,
+        help="Number of file jobs to run in parallel, defaults to {}".format(DEFAULT_JOBS))
+    add_release_args(parser)
+    parser.add_argument('--log', metavar='FILE', type=str,
+        help='Log progress in FILENAME, defaults to stdout')
+    return parser.parse_args()
+
+
+def read_applications(paths):
+    '''Yield a validated Application for every application found in paths'''
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.endswith(APPLICATION_SUFFIX):
+                    yield read_application_file(os.path.join(path, filename))
+        elif path == '-':
+            for application in read_application_stream(path, sys.stdin):
+                yield application
+        elif path.endswith(APPLICATION_STREAM_SUFFIX):
+            with open(path) as stream:
+                for application in read_application_stream(path, stream):
+                    yield application
+        else:
+            yield read_application_file(path)
+
+
+def read_application_file(path):
+    with open(path) as app_file:
+        application = Application(app_file)
+    logging.info("Input data application parsed: {}".format(path))
+    return application
+
+
+def read_application_stream(path, stream):
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if line:
+            source = "{}:{}".format(path, line_number)
+            application = Application(source, fields=json.loads(line))
+            logging.info("Input data application parsed: {}".format(source))
+            yield application
+
+
+def select_releases(applications, data_dir, consent):
+    '''Select the data for every application, sharing one metadata snapshot
+    and one file catalog between them'''
+    accepted = []
+    for application in applications:
+        application_dir = create_app_dir(application)
+        allowed_data_types = application.allowed_data_types()
+        logging.info("Allowed data types for {}: {}".format(application_dir, ' '.join(allowed_data_types)))
+        if len(allowed_data_types) > 0:
+            accepted.append((application, application_dir, allowed_data_types))
+        else:
+            logging.warning("No data available for application {}".format(application_dir))
+    if len(accepted) == 0:
+        return []
+    all_cohorts = sorted({ cohort for application, _dir, _allowed in accepted
+        for cohort in application.cohorts() })
+    metadata = Metadata(data_dir, all_cohorts)
+    logging.info("Metadata collected for requested cohorts: {}".format(' '.join(all_cohorts)))
+    catalog = FileCatalog()
+    return [select_release(application, application_dir, allowed_data_types,
+                data_dir, consent, metadata.select(application.cohorts()), catalog)
+            for application, application_dir, allowed_data_types in accepted]
+
+
+def main():
+    args = parse_args()
+    init_log(args.log)
+    applications = list(read_applications(args.apps))
+    gene_bed = load_gene_bed(args)
+    # before any output is written
+    for application in applications:
+        check_gene_bed(application, gene_bed)
+    releases = select_releases(applications, args.data, args.consent)
+    anonymised = [release for release in releases
+        if 'Anonymised' in release.allowed_data_types]
+    # generate random IDs for the samples of every anonymised release at once
+    id_groups = make_random_id_groups(args.usedids,
+        [release.metadata.sample_ids for release in anonymised])
+    randomised_ids = { release.application_dir: ids
+        for release, ids in zip(anonymised, id_groups) }
+    output_files = []
+    jobs = []
+    planned = []
+    for release in releases:
+        identifiers = original_identifiers(release)
+        metaout = os.path.join(release.application_dir, args.metaout)
+        release_outputs, release_jobs = plan_release(release,
+            randomised_ids.get(release.application_dir), metaout, args.materialise,
+            editor_options=editor_options(args), bam_editor_options=bam_editor_options(args),
+            gene_bed=gene_bed)
+        output_files.extend(release_outputs)
+        jobs.extend(release_jobs)
+        planned.append((release, metaout, identifiers))
+    logging.info("Running {} file jobs for {} applications".format(len(jobs), len(releases)))
+    pool = Pool(args.jobs)
+    try:
+        run_release_stages(args, planned, jobs, output_files, pool)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
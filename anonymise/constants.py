@@ -1 +1,6 @@
 BATCHES_DIR_NAME = "batches"
+# Batch directories are numbered, but batch IDs in file names and BAM read
+# groups are prefixed, e.g. batches/024 and AGRF_024
+BATCH_ID_PREFIX = "AGRF_"
+# File name meaning standard input or output
+STANDARD_STREAM = "-"
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+'''
+Long running anonymisation service.
+
+Starting anon.py for every request costs more than a small request itself:
+importing pysam, compiling the application schema, reading every
+samples.txt, listing the batch directories and reading the used IDs
+database. This program does all of that once and then serves requests,
+keeping warm:
+
+    - the sample metadata of every cohort requested so far, re-read only
+      when a samples.txt file or the batches directory changes
+    - the file catalog of the batch directories, re-listed only when a
+      listed directory changes
+    - the compiled application schema
+    - the used IDs database connection and its set of used IDs (new IDs
+      written by other programs are read before each allocation)
+    - a pool of worker processes, with pysam already imported, which runs
+      the file jobs and MD5 checksums of every request
+
+The service listens on a Unix socket (--socket) or a localhost TCP port
+(--port) and speaks HTTP with JSON bodies:
+
+    POST /jobs        submit an application JSON, returns the new job
+    GET  /jobs        the status of every job
+    GET  /jobs/ID     the status of one job
+
+The status of a job includes its stage (selecting, anonymising, md5,
+leak scan, packaging, uploading), the number of files finished out of the
+total, and, if it failed, the error. Output directories are created in the
+working directory of the service, as with anon.py.
+
+Usage:
+
+    daemon.py --data DIR --consent FILE --socket /run/anonymise.sock [--workers 2] [--jobs 8]
+    curl --unix-socket /run/anonymise.sock -d @application.json http://localhost/jobs
+    curl --unix-socket /run/anonymise.sock http://localhost/jobs/1
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+from __future__ import print_function
+import os
+import json
+import time
+import logging
+import threading
+import socketserver
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from application import Application, application_validator
+from random_id import RandomIdAllocator
+from metadata import Metadata, batch_metadata_paths, DEFAULT_METADATA_OUT_FILENAME
+from constants import BATCHES_DIR_NAME
+from get_files import FileCatalog
+from anon import create_app_dir, select_release, plan_release, run_release_stages, add_release_args, \
+    init_log, editor_options, bam_editor_options, load_gene_bed, check_gene_bed, original_identifiers
+from error import error_name
+from version import program_version
+
+DEFAULT_JOBS = 1
+DEFAULT_WORKERS = 1
+LOCALHOST = "127.0.0.1"
+JOBS_PATH = "/jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+
+def parse_args():
+    """Serve anonymisation requests from a long running process"""
+    parser = ArgumentParser(description="Serve anonymisation requests from a long running process, version {}".format(program_version))
+    parser.add_argument('--version', action='version', version='%(prog)s ' + program_version)
+    listen = parser.add_mutually_exclusive_group(required=True)
+    listen.add_argument("--socket", type=str, help="Unix socket to listen on")
+    listen.add_argument("--port", type=int, help="TCP port to listen on, on localhost only")
+    parser.add_argument("--data", required=True,
+        type=str, help="Directory containing production data")
+    parser.add_argument("--metaout",
+        required=False, default=DEFAULT_METADATA_OUT_FILENAME, type=str,
+        help="Name of output metadatafile in each application directory, defaults to {}".format(DEFAULT_METADATA_OUT_FILENAME))
+    parser.add_argument("--consent", required=True, type=str,
+        help="File path of consent metadata")
+    parser.add_argument("--workers", required=False, type=int, default=DEFAULT_WORKERS,
+        help="Number of applications to process at the same time, defaults to {}".format(DEFAULT_WORKERS))
+    parser.add_argument("--jobs", required=False, type=int, default=DEFAULT_JOBS,
+        help="Number of processes running file jobs, shared by all applications, defaults to {}".format(DEFAULT_JOBS))
+    add_release_args(parser)
+    parser.add_argument('--log', metavar='FILE', type=str,
+        help='Log progress in FILENAME, defaults to stdout')
+    return parser.parse_args()
+
+
+class Job(object):
+    '''One submitted application and its progress'''
+
+    def __init__(self, job_id, application):
+        self.id = job_id
+        self.application = application
+        self.status = QUEUED
+        self.stage = None
+        self.application_dir = None
+        self.files_done = 0
+        self.files_total = 0
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def start_stage(self, stage):
+        self.stage = stage
+
+    def file_finished(self, output):
+        self.files_done += 1
+
+    def to_json(self):
+        return { 'id': self.id, 'status': self.status,
+            'stage': self.stage, 'application_dir': self.application_dir,
+            'files_done': self.files_done, 'files_total': self.files_total,
+            'error': self.error, 'submitted': self.submitted,
+            'started': self.started, 'finished': self.finished }
+
+
+def metadata_signature(data_dir):
+    '''Modification times of everything the metadata is read from'''
+    signature = [os.stat(os.path.join(data_dir, BATCHES_DIR_NAME)).st_mtime]
+    for path in sorted(batch_metadata_paths(data_dir)):
+        try:
+            signature.append((path, os.stat(path).st_mtime))
+        except OSError:
+            signature.append((path, None))
+    return signature
+
+
+class Service(object):
+    '''The warm state shared by all jobs, and the queue which runs them'''
+
+    def __init__(self, args):
+        self.args = args
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.next_id = 1
+        self.cache_lock = threading.Lock()
+        self.metadata = None
+        self.metadata_cohorts = set()
+        self.metadata_signature = None
+        self.catalog = FileCatalog()
+        self.gene_bed = load_gene_bed(args)
+        self.ids_lock = threading.Lock()
+        self.allocator = RandomIdAllocator(args.usedids, check_same_thread=False)
+        # compile the schema, and load pysam before the pool is forked so
+        # the worker processes start with it
+        application_validator()
+        import pysam
+        self.pool = Pool(args.jobs)
+        self.executor = ThreadPoolExecutor(args.workers)
+
+    def submit(self, application):
+        with self.jobs_lock:
+            job = Job(self.next_id, application)
+            self.jobs[job.id] = job
+            self.next_id += 1
+        logging.info("Job {} submitted".format(job.id))
+        self.executor.submit(self.run, job)
+        return job
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def all_jobs(self):
+        with self.jobs_lock:
+            return [self.jobs[job_id] for job_id in sorted(self.jobs)]
+
+    def select(self, cohorts):
+        '''The metadata for cohorts and the file catalog, both re-read if
+        the production data has changed since they were read'''
+        with self.cache_lock:
+            signature = metadata_signature(self.args.data)
+            if signature != self.metadata_signature or not self.metadata_cohorts.issuperset(cohorts):
+                self.metadata_cohorts.update(cohorts)
+                self.metadata = Metadata(self.args.data, sorted(self.metadata_cohorts))
+                self.metadata_signature = signature
+                logging.info("Metadata collected for cohorts: {}".format(' '.join(sorted(self.metadata_cohorts))))
+            if self.catalog.stale():
+                logging.info("Production data changed, files will be searched for again")
+                self.catalog = FileCatalog()
+            return self.metadata.select(cohorts), self.catalog
+
+    def randomise(self, sample_ids):
+        with self.ids_lock:
+            self.allocator.refresh()
+            ids = self.allocator.randomise(sample_ids)
+            self.allocator.commit()
+        return ids
+
+    def run(self, job):
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            self.run_stages(job)
+        except SystemExit as e:
+            # the stages report errors as anon.py does, by exiting
+            job.error = error_name(e.code)
+        except Exception as e:
+            logging.exception("Job {} failed".format(job.id))
+            job.error = str(e)
+        job.status = FAILED if job.error is not None else FINISHED
+        job.finished = time.time()
+        logging.info("Job {} {} in {:.1f}s".format(job.id, job.status, job.finished - job.started))
+
+    def run_stages(self, job):
+        args = self.args
+        application = job.application
+        job.stage = "selecting"
+        # before any output is written
+        check_gene_bed(application, self.gene_bed)
+        application_dir = create_app_dir(application)
+        job.application_dir = application_dir
+        allowed_data_types = application.allowed_data_types()
+        if len(allowed_data_types) == 0:
+            logging.warning("No data available for application {}".format(application_dir))
+            return
+        cohorts = application.cohorts()
+        metadata, catalog = self.select(cohorts)
+        release = select_release(application, application_dir, allowed_data_types,
+            args.data, args.consent, metadata, catalog)
+        identifiers = original_identifiers(release)
+        randomised_ids = None
+        if 'Anonymised' in allowed_data_types:
+            randomised_ids = self.randomise(release.metadata.sample_ids)
+        metaout = os.path.join(application_dir, args.metaout)
+        output_files, file_jobs = plan_release(release, randomised_ids, metaout,
+            args.materialise, editor_options=editor_options(args),
+            bam_editor_options=bam_editor_options(args), gene_bed=self.gene_bed)
+        job.files_total = len(file_jobs)
+        run_release_stages(args, [(release, metaout, identifiers)], file_jobs, output_files,
+            self.pool, stage=job.start_stage, job_finished=job.file_finished)
+        job.stage = None
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+        self.pool.join()
+        self.allocator.close()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''The HTTP interface to the Service, which is server.service'''
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path.rstrip('/') == JOBS_PATH:
+            self.send_json(200, [job.to_json() for job in service.all_jobs()])
+            return
+        job = self.path_job()
+        if job is None:
+            self.send_json(404, { 'error': "no such job: {}".format(self.path) })
+        else:
+            self.send_json(200, job.to_json())
+
+    def do_POST(self):
+        if self.path.rstrip('/') != JOBS_PATH:
+            self.send_json(404, { 'error': "no such path: {}".format(self.path) })
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            fields = json.loads(self.rfile.read(length).decode('utf-8'))
+            application = Application("submitted application", fields=fields)
+        except ValueError as e:
+            self.send_json(400, { 'error': "application is not valid JSON: {}".format(e) })
+            return
+        except SystemExit as e:
+            self.send_json(400, { 'error': error_name(e.code) })
+            return
+        job = self.server.service.submit(application)
+        self.send_json(202, job.to_json())
+
+    def path_job(self):
+        prefix = JOBS_PATH + '/'
+        if not self.path.startswith(prefix):
+            return None
+        try:
+            return self.server.service.get_job(int(self.path[len(prefix):].rstrip('/')))
+        except ValueError:
+            return None
+
+    def send_json(self, status, value):
+        body = json.dumps(value, indent=1).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("HTTP " + format % args)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address or 'local')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(args):
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        return UnixHTTPServer(args.socket, RequestHandler)
+    return ThreadingHTTPServer((LOCALHOST, args.port), RequestHandler)
+
+
+def main():
+    args = parse_args()
+    init_log(args.log)
+    service = Service(args)
+    server = make_server(args)
+    server.service = service
+    logging.info("Listening on {}".format(args.socket or "{}:{}".format(LOCALHOST, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
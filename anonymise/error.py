@@ -15,7 +15,19 @@ ERROR_BAD_ALLOWED_DATA = 8
 ERROR_RANDOMISE_ID = 9
 ERROR_BAD_FILENAME = 10
 ERROR_MD5 = 11
+ERROR_UPLOAD = 12
+ERROR_VERIFY = 13
+ERROR_LEAK = 14
+ERROR_QUEUE = 15
+ERROR_GENE_REGIONS = 16
 
 def print_error(message):
     print("{}: ERROR: {}".format(PROGRAM_NAME, message), file=sys.stderr)
 
+
+def error_name(code):
+    '''The name of an exit code, e.g. ERROR_MD5 for 11'''
+    for name, value in globals().items():
+        if name.startswith('ERROR_') and value == code:
+            return name
+    return "exit status {}".format(code)
@@ -24,27 +24,62 @@ ALIGN_DIR_NAME = "align"
 VCF_DIR_NAME = "variants"
 
 
-def get_files(data_dir, file_types, metadata):
+def get_files(data_dir, file_types, metadata, catalog=None):
+    if catalog is None:
+        catalog = FileCatalog()
     fastqs = []
     bams = []
     bais = []
     vcfs = []
     if "fastq" in file_types:
-        fastqs = get_files_by_type(data_dir, metadata, FASTQ_filename) 
+        fastqs = get_files_by_type(data_dir, metadata, FASTQ_filename, catalog) 
     if "bam" in file_types:
-        bams = get_files_by_type(data_dir, metadata, BAM_filename) 
-        bais = get_files_by_type(data_dir, metadata, BAI_filename)
+        bams = get_files_by_type(data_dir, metadata, BAM_filename, catalog) 
+        bais = get_files_by_type(data_dir, metadata, BAI_filename, catalog)
     if "vcf" in file_types:
-        vcfs = get_files_by_type(data_dir, metadata, VCF_filename) 
+        vcfs = get_files_by_type(data_dir, metadata, VCF_filename, catalog) 
     return fastqs, bams, bais, vcfs
 
 
-def get_files_by_type(datadir, metadata, file_type):
+class FileCatalog(object):
+    '''Directory listings of the production data, each read at most once.
+
+    Sharing one catalog between several applications means each batch
+    directory is only listed once, no matter how many requests use it.'''
+
+    def __init__(self):
+        self.listings = {}
+        # modification time of each directory when it was listed
+        self.mtimes = {}
+
+    def listdir(self, directory):
+        try:
+            return self.listings[directory]
+        except KeyError:
+            logging.info("Searching for files in: {}".format(directory))
+            # taken before listing, so a change during listing is not missed
+            self.mtimes[directory] = os.stat(directory).st_mtime
+            listing = os.listdir(directory)
+            self.listings[directory] = listing
+            return listing
+
+    def stale(self):
+        '''True if files were added to or removed from any directory since
+        it was listed'''
+        for directory, mtime in list(self.mtimes.items()):
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+def get_files_by_type(datadir, metadata, file_type, catalog):
     results = []
     for batch in metadata.batches:
         directory = file_type.make_batch_dir(datadir, batch)
-        all_filenames = os.listdir(directory)
-        logging.info("Searching for files in: {}".format(directory))
+        all_filenames = catalog.listdir(directory)
         for filename in all_filenames:
             full_path = os.path.join(directory, filename)
             try:
@@ -105,6 +140,10 @@ class Data_filename(object):
         new_path = os.path.join(directory, new_id + rest)
         self.absolute_path = new_path
 
+    # Most file names do not contain a batch id, can be overridden for special cases
+    def get_batch_id(self):
+        return None
+
 
 class FASTQ_filename(Data_filename):
     def __init__(self, absolute_path):
@@ -149,6 +188,17 @@ class FASTQ_filename(Data_filename):
         new_path = os.path.join(directory, new_id + filename[prefix_len:])
         self.absolute_path = new_path
 
+    def get_batch_id(self):
+        """
+        Batch id is fields 1 and 2, e.g. AGRF_024
+
+        """
+        fields = self.get_fields(self.get_filename())
+        return fields[1] + '_' + fields[2]
+
+    def replace_batch_id(self, new_batch_id):
+        self.replace_field(new_batch_id, 1, 2)
+
     def replace_field(self, new_id, field_index_start, field_index_end=None):
         """
         A field is a substring in filename separated by '_'
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+'''
+Scan release outputs for identifiers which should have been anonymised.
+
+The editors only replace identifiers in the places they know about, so the
+original sample IDs or batch IDs (e.g. AGRF_024) can survive elsewhere, for
+example in @PG command lines, comments or other tags. This scanner searches
+every output file for all of the original identifiers at once:
+
+    - all identifiers are compiled into a single multi-pattern matcher (an
+      Aho-Corasick automaton if the pyahocorasick library is installed,
+      otherwise one regular expression with the common prefixes of the
+      identifiers factored out)
+    - gzip and BGZF compressed files (BAM, .gz) are decompressed as they
+      are read, so the search sees the real content
+    - files are read in large blocks, with an overlap so that matches across
+      block boundaries are found, and scanned in parallel
+    - file names are checked as well as contents
+
+Each match is reported with the file, the offset in the (decompressed)
+content, and the identifier found.
+
+Only the identifiers anonymisation replaces are searched for. Flowcell IDs
+are not: FASTQ files are released unedited, so they keep their flowcells in
+their names and read headers, and BAM read names and platform units keep
+them to match.
+
+Usage:
+
+    leak_scan.py --dir APPID/REQID --identifiers original_ids.txt [--jobs 4]
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+from __future__ import print_function
+import os
+import re
+import sys
+import logging
+from multiprocessing import Pool
+from argparse import ArgumentParser
+from get_files import FASTQ_filename, FileTypeException
+from package import release_files
+from constants import BATCH_ID_PREFIX
+
+# Shorter identifiers match too much by chance to be useful
+MIN_IDENTIFIER_LENGTH = 4
+SCAN_BLOCK_SIZE = 4 << 20
+MAX_REPORTED_MATCHES = 100
+DEFAULT_SCAN_JOBS = 1
+GZIP_MAGIC = b'\x1f\x8b'
+LEAK_REPORT_SUFFIX = ".leaks.txt"
+
+
+def parse_args():
+    """Scan a release directory for original identifiers"""
+    parser = ArgumentParser(description="Scan a release directory for identifiers which should have been anonymised")
+    parser.add_argument("--dir", required=True, type=str, help="release directory to scan")
+    parser.add_argument("--identifiers", required=True, type=str,
+        help="file of original identifiers to search for, one per line")
+    parser.add_argument("--jobs", required=False, type=int, default=DEFAULT_SCAN_JOBS,
+        help="number of files to scan in parallel, defaults to {}".format(DEFAULT_SCAN_JOBS))
+    return parser.parse_args()
+
+
+def identifiers_from_metadata(metadata, source_files=()):
+    '''The original identifiers of a release which anonymisation replaces:
+    sample IDs and batch IDs from the metadata, and batch IDs from the names
+    of the source files. metadata must not have been anonymised yet.'''
+    identifiers = set(metadata.sample_ids)
+    identifiers.update(BATCH_ID_PREFIX + batch for batch in metadata.batches)
+    for path in source_files:
+        try:
+            file_handler = FASTQ_filename(path)
+        except FileTypeException:
+            continue
+        # Example filename: 010108101_AGRF_024_HG3JKBCXX_CGTACTAG_L001_R1.fastq.gz
+        batch_id = file_handler.get_batch_id()
+        if batch_id is not None:
+            identifiers.add(batch_id)
+    return sorted(identifier for identifier in identifiers
+        if len(identifier) >= MIN_IDENTIFIER_LENGTH)
+
+
+def trie_pattern(identifiers):
+    '''A regular expression (bytes) matching any of the identifiers, with
+    their common prefixes factored out (0(?:1(?:0|2)|2) for 010, 012 and 02),
+    so the work at each position of the data depends on the length of the
+    identifiers rather than their number. Longer identifiers are preferred,
+    so that an identifier which contains another is reported in full.'''
+    trie = {}
+    for identifier in identifiers:
+        node = trie
+        for byte in identifier:
+            node = node.setdefault(byte, {})
+        node[None] = True
+    return trie_node_pattern(trie)
+
+
+def trie_node_pattern(node):
+    leaves = []
+    branches = []
+    for byte, child in sorted((byte, child) for byte, child in node.items() if byte is not None):
+        if list(child) == [None]:
+            leaves.append(re.escape(bytes([byte])))
+        else:
+            branches.append(re.escape(bytes([byte])) + trie_node_pattern(child))
+    if len(leaves) > 1:
+        branches.append(b'[' + b''.join(leaves) + b']')
+    else:
+        branches.extend(leaves)
+    pattern = branches[0] if len(branches) == 1 else b'(?:' + b'|'.join(branches) + b')'
+    # the identifier ending here is matched only if no longer one does
+    if None in node:
+        pattern = b'(?:' + pattern + b')?'
+    return pattern
+
+
+class IdentifierMatcher(object):
+    '''Finds all occurrences of many identifiers in bytes in one pass'''
+
+    def __init__(self, identifiers):
+        self.identifiers = sorted({ identifier.encode('utf-8') for identifier in identifiers })
+        self.max_length = max([len(identifier) for identifier in self.identifiers] or [0])
+        try:
+            import ahocorasick
+        except ImportError:
+            self.automaton = None
+            self.pattern = re.compile(trie_pattern(self.identifiers)) if self.identifiers else None
+        else:
+            # bytes are searched as latin-1 text, which maps each byte to
+            # one character, so offsets are unchanged
+            self.automaton = ahocorasick.Automaton(ahocorasick.STORE_LENGTH)
+            for identifier in self.identifiers:
+                self.automaton.add_word(identifier.decode('latin-1'))
+            self.automaton.make_automaton()
+
+    def find(self, data):
+        '''Yield (offset, identifier) for each match in data'''
+        if not self.identifiers:
+            return
+        if self.automaton is None:
+            for match in self.pattern.finditer(data):
+                yield match.start(), match.group().decode('utf-8', 'replace')
+        else:
+            for end, length in self.automaton.iter(data.decode('latin-1')):
+                start = end - length + 1
+                yield start, data[start:end + 1].decode('utf-8', 'replace')
+
+
+def open_content(path):
+    '''Open a file for reading, decompressing gzip and BGZF files'''
+    with open(path, 'rb') as probe:
+        magic = probe.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        import gzip
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def scan_file(matcher, path, display_name):
+    '''Return (number of matches, [(name, offset, identifier)]) for one file'''
+    found = []
+    total = 0
+    for offset, identifier in matcher.find(display_name.encode('utf-8')):
+        total += 1
+        found.append((display_name, 'filename', identifier))
+    overlap = max(matcher.max_length - 1, 0)
+    # offset of the start of tail in the decompressed content
+    tail = b''
+    tail_offset = 0
+    with open_content(path) as content:
+        while True:
+            block = content.read(SCAN_BLOCK_SIZE)
+            if not block:
+                break
+            data = tail + block
+            for offset, identifier in matcher.find(data):
+                # matches entirely inside the tail were found last time
+                if offset + len(identifier.encode('utf-8')) > len(tail):
+                    total += 1
+                    if len(found) < MAX_REPORTED_MATCHES:
+                        found.append((display_name, tail_offset + offset, identifier))
+            new_tail = data[-overlap:] if overlap else b''
+            tail_offset += len(data) - len(new_tail)
+            tail = new_tail
+    return total, found
+
+
+# Each worker process builds its own matcher once
+WORKER_MATCHER = None
+
+def init_worker(identifiers):
+    global WORKER_MATCHER
+    WORKER_MATCHER = IdentifierMatcher(identifiers)
+
+def scan_worker(arguments):
+    path, display_name = arguments
+    return scan_file(WORKER_MATCHER, path, display_name)
+
+
+def scan_files(identifiers, paths, jobs=DEFAULT_SCAN_JOBS, base_dir=None):
+    '''Scan all paths for the identifiers. Returns the total number of matches
+    and a list of reported (file, offset, identifier) matches.'''
+    tasks = [(path, path if base_dir is None else os.path.relpath(path, base_dir)) for path in paths]
+    total = 0
+    found = []
+    if jobs > 1:
+        pool = Pool(jobs, initializer=init_worker, initargs=(identifiers,))
+        try:
+            results = list(pool.imap(scan_worker, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        matcher = IdentifierMatcher(identifiers)
+        results = [scan_file(matcher, path, display_name) for path, display_name in tasks]
+    for file_total, file_found in results:
+        total += file_total
+        found.extend(file_found)
+    return total, found
+
+
+def write_leak_report(report_filename, total, found):
+    '''The report contains original identifiers, so it must not be written
+    inside the release directory'''
+    with open(report_filename, 'w') as report:
+        for name, offset, identifier in found:
+            report.write("{}\t{}\t{}\n".format(name, offset, identifier))
+        report.write("total\t{}\n".format(total))
+
+
+def scan_release(directory, identifiers, extra_files=(), jobs=DEFAULT_SCAN_JOBS):
+    '''Scan every file in a release directory (and any extra_files), writing
+    a report to directory.leaks.txt. Returns the number of matches.'''
+    directory = os.path.normpath(directory)
+    paths = list(release_files(directory)) + list(extra_files)
+    total, found = scan_files(identifiers, paths, jobs, os.path.dirname(directory))
+    report_filename = directory + LEAK_REPORT_SUFFIX
+    write_leak_report(report_filename, total, found)
+    if total > 0:
+        logging.error("Found {} original identifiers in {}, see {}".format(total, directory, report_filename))
+    else:
+        logging.info("No original identifiers found in {}".format(directory))
+    return total
+
+
+def main():
+    args = parse_args()
+    with open(args.identifiers) as identifiers_file:
+        identifiers = [line.strip() for line in identifiers_file if line.strip()]
+    total = scan_release(args.dir, identifiers, jobs=args.jobs)
+    print("{} original identifiers found, see {}".format(total,
+        os.path.normpath(args.dir) + LEAK_REPORT_SUFFIX))
+    sys.exit(1 if total > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+'''
+Materialise unedited deliverable files in a release directory.
+
+By default files which do not need editing are symbolically linked into the
+release directory. Symbolic links point back into production storage, so
+they break when the release directory is exported to another mount or
+archived. Instead files can be materialised as:
+
+    - hardlink: a hard link to the original (same filesystem only)
+    - reflink: a copy-on-write clone (btrfs, XFS, OCFS2 and friends)
+    - copy: a kernel-side copy with copy_file_range, no data passes
+      through user space
+
+If a method is not supported for a particular file (for example a hard link
+across filesystems) the next cheapest method is tried, finishing with an
+ordinary copy. Each file falls back independently.
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+import os
+import errno
+import fcntl
+import shutil
+import logging
+
+SYMLINK = "symlink"
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+COPY = "copy"
+MATERIALISE_METHODS = [SYMLINK, HARDLINK, REFLINK, COPY]
+DEFAULT_MATERIALISE = SYMLINK
+
+# ioctl request number for FICLONE, from linux/fs.h
+FICLONE = 0x40049409
+# Largest request passed to copy_file_range at a time
+COPY_CHUNK_SIZE = 1 << 30
+
+# Errors which mean "this method does not work here", as opposed to a
+# genuine failure such as a missing input or an existing output
+UNSUPPORTED_ERRNOS = { errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY,
+    errno.EINVAL, errno.ENOSYS, errno.EPERM, errno.EMLINK }
+
+
+def symlink_file(source, dest):
+    os.symlink(source, dest)
+
+
+def hardlink_file(source, dest):
+    os.link(source, dest, follow_symlinks=True)
+
+
+def reflink_file(source, dest):
+    with open(source, 'rb') as source_file:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dest_fd, FICLONE, source_file.fileno())
+        finally:
+            os.close(dest_fd)
+
+
+def copy_range_file(source, dest):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    with open(source, 'rb') as source_file:
+        dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            while os.copy_file_range(source_file.fileno(), dest_fd, COPY_CHUNK_SIZE) > 0:
+                pass
+        finally:
+            os.close(dest_fd)
+
+
+def plain_copy_file(source, dest):
+    if os.path.lexists(dest):
+        raise OSError(errno.EEXIST, "File exists", dest)
+    shutil.copyfile(source, dest)
+
+
+# The methods to try, in order, for each requested materialisation
+FALLBACKS = {
+    SYMLINK: [(SYMLINK, symlink_file)],
+    HARDLINK: [(HARDLINK, hardlink_file), (REFLINK, reflink_file),
+               (COPY, copy_range_file), (COPY, plain_copy_file)],
+    REFLINK: [(REFLINK, reflink_file), (COPY, copy_range_file),
+              (COPY, plain_copy_file)],
+    COPY: [(COPY, copy_range_file), (COPY, plain_copy_file)],
+}
+
+
+def materialise(method, source, dest):
+    '''Make dest a link to, or copy of, source using the requested method,
+    falling back to cheaper alternatives when it is not supported. Returns
+    the method that was actually used.'''
+    attempts = FALLBACKS[method]
+    for index, (used_method, attempt) in enumerate(attempts):
+        try:
+            attempt(source, dest)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS or index == len(attempts) - 1:
+                raise
+            # remove any partial output before trying the next method
+            if os.path.lexists(dest):
+                os.remove(dest)
+            logging.info("Cannot {} {} to {} ({}), trying the next method".format(
+                attempt.__name__.replace('_file', ''), source, dest, e.strerror))
+        else:
+            return used_method
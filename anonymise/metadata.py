@@ -4,8 +4,10 @@ Metadata processing.
 
 import os
 import csv
+from collections import namedtuple
 from constants import BATCHES_DIR_NAME
 from error import print_error, ERROR_RANDOMISE_ID
+from regions import parse_genes
 
 METADATA_FILENAME = "samples.txt"
 DEFAULT_METADATA_OUT_FILENAME = "samples.out.txt"
@@ -22,6 +24,12 @@ METADATA_HEADINGS = ['Batch', 'Sample_ID', 'DNA_Tube_ID', 'Sex',
     'Demultiplex_Software', 'Hospital_Centre',
     'Sequencing_Contact', 'Pipeline_Contact', 'Notes']
 
+# One sample's metadata. A named tuple over the fixed headings is much
+# smaller than a dictionary per row, which matters for large cohorts.
+# Columns missing from a samples.txt file are empty strings, and columns
+# which are not in METADATA_HEADINGS are ignored.
+SampleRow = namedtuple('SampleRow', METADATA_HEADINGS)
+
 # Metadata desribing samples is in:
 #    $datadir/batches/$batchNum/samples.txt
 # batch numbers are directory names with three digits in their name
@@ -33,56 +41,135 @@ class Metadata(object):
     def __init__(self, datadir, cohorts):
         '''Return a dictionary mapping batch number to a list of sample
         metadata, for all samples in the desired cohort'''
-        self.samples = []
-        batches_dir = os.path.join(datadir, BATCHES_DIR_NAME)
-        batches_dir_contents = os.listdir(batches_dir)
-        for file in batches_dir_contents:
-            if is_batch_dir(file):
-                batch_number = file
-                metadata_path = os.path.join(batches_dir, batch_number, METADATA_FILENAME)
-                samples_infos = get_batch_metadata(cohorts, metadata_path)
-                self.samples.extend(samples_infos)
+        samples = []
+        for metadata_path in batch_metadata_paths(datadir):
+            samples.extend(get_batch_metadata(cohorts, metadata_path))
+        self.set_samples(samples)
+
+    @classmethod
+    def from_samples(cls, samples):
+        '''Build metadata from already parsed sample rows'''
+        metadata = cls.__new__(cls)
+        metadata.set_samples(samples)
+        return metadata
+
+    def set_samples(self, samples):
+        self.samples = samples
         # set of all batches used by all samples in all cohorts
-        self.batches = { sample['Batch'] for sample in self.samples }
+        self.batches = { sample.Batch for sample in self.samples }
         # set of all sample IDs used by all samples in all cohorts
         self.update_sample_ids()
 
+    def select(self, cohorts):
+        '''Return the metadata for the samples in the given cohorts, without
+        re-reading samples.txt. Rows are immutable, so they are shared.'''
+        return Metadata.from_samples([sample for sample in self.samples
+            if sample.Cohort in cohorts])
+
     def update_sample_ids(self):
-        self.sample_ids = { sample['Sample_ID'] for sample in self.samples }
+        self.sample_ids = { sample.Sample_ID for sample in self.samples }
 
     def filter_consent(self, consent_file, allowed_data_types):
         # XXX fixme, don't forget to filter the self.sample_ids as well
         pass
 
     def anonymise(self, randomised_ids):
+        anonymised = []
         for sample in self.samples:
-            old_id = sample['Sample_ID']
+            old_id = sample.Sample_ID
             try:
-                sample['Sample_ID'] = randomised_ids[old_id]
+                anonymised.append(sample._replace(Sample_ID=randomised_ids[old_id]))
             except KeyError:
                 print_error("Cannot anonymise sample {}".format(old_id))
                 exit(ERROR_RANDOMISE_ID)
+        self.samples = anonymised
         self.update_sample_ids()
 
     def write(self, filename):
         with open(filename, 'w') as out_file:
-            writer = csv.DictWriter(out_file, fieldnames=METADATA_HEADINGS)
-            writer.writeheader()
-            for sample in self.samples:
-                writer.writerow(sample)
+            writer = csv.writer(out_file)
+            writer.writerow(METADATA_HEADINGS)
+            writer.writerows(self.samples)
+
+    def get_sample_ids(self):
+        return self.sample_ids
+
+    def prioritised_genes(self):
+        '''Sample ID to the list of its prioritised genes'''
+        genes = {}
+        for sample in self.samples:
+            genes.setdefault(sample.Sample_ID, []).extend(parse_genes(sample.Prioritised_Genes))
+        return genes
+
+
+class MetadataSummary(object):
+    '''The sample and batch IDs (and prioritised genes) of metadata
+    written by stream_metadata, without the rows themselves'''
+    __slots__ = ('sample_ids', 'batches', 'genes')
+
+    def __init__(self):
+        self.sample_ids = set()
+        self.batches = set()
+        self.genes = {}
+
+    def filter_consent(self, consent_file, allowed_data_types):
+        # consent is not handled yet, see Metadata.filter_consent
+        pass
 
     def get_sample_ids(self):
         return self.sample_ids
 
+    def prioritised_genes(self):
+        return self.genes
+
+
+def stream_metadata(datadir, cohorts, output_filename, randomise=None):
+    '''Read the metadata for all samples in the desired cohorts, replace
+    sample IDs with randomise(sample_id) (unless randomise is None) and
+    write it to output_filename, all in one pass. Only the original sample
+    IDs, the batches and the prioritised genes are kept in memory.'''
+    summary = MetadataSummary()
+    with open(output_filename, 'w') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow(METADATA_HEADINGS)
+        for metadata_path in batch_metadata_paths(datadir):
+            for sample in read_batch_metadata(cohorts, metadata_path):
+                summary.sample_ids.add(sample.Sample_ID)
+                summary.batches.add(sample.Batch)
+                summary.genes.setdefault(sample.Sample_ID, []).extend(parse_genes(sample.Prioritised_Genes))
+                if randomise is not None:
+                    sample = sample._replace(Sample_ID=randomise(sample.Sample_ID))
+                writer.writerow(sample)
+    return summary
+
+
+def batch_metadata_paths(datadir):
+    batches_dir = os.path.join(datadir, BATCHES_DIR_NAME)
+    batches_dir_contents = os.listdir(batches_dir)
+    for file in batches_dir_contents:
+        if is_batch_dir(file):
+            batch_number = file
+            yield os.path.join(batches_dir, batch_number, METADATA_FILENAME)
+
 
 def get_batch_metadata(cohorts, metadata_filename):
-    result = []
+    return list(read_batch_metadata(cohorts, metadata_filename))
+
+
+def read_batch_metadata(cohorts, metadata_filename):
+    '''Yield a SampleRow for each sample in the desired cohorts'''
     with open(metadata_filename) as metadata_file:
-        reader = csv.DictReader(metadata_file, delimiter='\t')
+        reader = csv.reader(metadata_file, delimiter='\t')
+        header = next(reader, [])
+        columns = [header.index(heading) if heading in header else None
+            for heading in METADATA_HEADINGS]
+        cohort_column = columns[METADATA_HEADINGS.index('Cohort')]
+        if cohort_column is None:
+            return
         for row in reader:
-            if row["Cohort"] in cohorts:
-                result.append(row)
-        return result
+            if len(row) > cohort_column and row[cohort_column] in cohorts:
+                yield SampleRow._make(row[column] if column is not None and column < len(row) else ''
+                    for column in columns)
 
 
 # We assume batch filenames are all digits and nothing else
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+'''
+Package a release directory into tar archives for upload.
+
+Every file in the directory is streamed once, straight into the archive
+(symbolic links are dereferenced, so the archive is self-contained). While
+the data passes through, an MD5 checksum is computed for each member, for
+the whole tar stream, and for each archive file written to disk, so no file
+is read twice. The checksums are written to a manifest next to the archive.
+
+Optionally the archive can be:
+
+    - compressed, with blocks gzipped in parallel. Each block is a separate
+      gzip member, so the result is an ordinary gzip file.
+    - split into parts of a fixed size. Concatenating the parts in order
+      gives back the complete archive, e.g. cat R1.tar.gz.* | tar xz
+
+Manifest format, tab separated, one line per checksum:
+
+    member  <md5>  <size>  <name in archive>
+    archive <md5>  <size>  <name of tar stream, before compression>
+    part    <md5>  <size>  <archive file name>
+
+Usage:
+
+    package.py --dir APPID/REQID [--compress] [--part-size 2G] [--jobs 4]
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+import os
+import gzip
+import hashlib
+import logging
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, ArgumentTypeError
+
+TAR_SUFFIX = ".tar"
+GZIP_SUFFIX = ".gz"
+MANIFEST_SUFFIX = ".manifest.txt"
+PART_SUFFIX = ".{:03d}"
+READ_BLOCK_SIZE = 1 << 20
+COMPRESS_BLOCK_SIZE = 4 << 20
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_PACKAGE_JOBS = 1
+SIZE_UNITS = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+
+
+def parse_args():
+    """Package a release directory into tar archives"""
+    parser = ArgumentParser(description="Package a release directory into tar archives with a checksum manifest")
+    parser.add_argument("--dir", required=True, type=str, help="release directory to package")
+    parser.add_argument("--output", required=False, type=str,
+        help="archive file name prefix, defaults to the directory name followed by {}".format(TAR_SUFFIX))
+    add_package_args(parser, "")
+    return parser.parse_args()
+
+
+def add_package_args(parser, prefix):
+    '''Packaging options, shared with the programs which call package_release'''
+    parser.add_argument("--{}compress".format(prefix), required=False, action="store_true",
+        help="gzip compress the archive")
+    parser.add_argument("--{}part-size".format(prefix), required=False, type=parse_size,
+        help="split the archive into parts of this many bytes (suffixes K, M, G and T are allowed)")
+    parser.add_argument("--{}jobs".format(prefix), required=False, type=int, default=DEFAULT_PACKAGE_JOBS,
+        help="number of threads used for compression, defaults to {}".format(DEFAULT_PACKAGE_JOBS))
+
+
+def parse_size(text):
+    '''Parse a size in bytes with an optional K, M, G or T suffix'''
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_UNITS:
+        size = int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+    else:
+        size = int(text)
+    if size < 1:
+        raise ArgumentTypeError("must be at least 1 byte, not {}".format(size))
+    return size
+
+
+class HashingReader(object):
+    '''Read from a file, computing the MD5 of everything read'''
+
+    def __init__(self, file):
+        self.file = file
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.md5.update(data)
+        self.size += len(data)
+        return data
+
+
+class ArchiveWriter(object):
+    '''A write only file object which receives the tar stream. It checksums
+    the stream, optionally compresses it in parallel, and writes it into one
+    or more part files, checksumming each part as it is written.'''
+
+    def __init__(self, output_prefix, part_size=None, compress=False, jobs=DEFAULT_PACKAGE_JOBS):
+        self.output_prefix = output_prefix
+        self.part_size = part_size
+        self.compress = compress
+        self.md5 = hashlib.md5()
+        self.size = 0
+        # (filename, md5, size) of every part written so far
+        self.parts = []
+        self.part_file = None
+        self.part_md5 = None
+        self.part_written = 0
+        self.block = bytearray()
+        self.jobs = max(1, jobs)
+        self.executor = ThreadPoolExecutor(self.jobs) if compress else None
+        self.pending = deque()
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        if not self.compress:
+            self.write_output(data)
+            return len(data)
+        self.block += data
+        while len(self.block) >= COMPRESS_BLOCK_SIZE:
+            self.submit(bytes(self.block[:COMPRESS_BLOCK_SIZE]))
+            del self.block[:COMPRESS_BLOCK_SIZE]
+        return len(data)
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(gzip.compress, block, DEFAULT_COMPRESS_LEVEL))
+        # bound the amount of data held in memory, and keep the output in order
+        while len(self.pending) > 2 * self.jobs:
+            self.write_output(self.pending.popleft().result())
+
+    def write_output(self, data):
+        while data:
+            if self.part_file is None:
+                self.open_part()
+            if self.part_size is None:
+                chunk = data
+            else:
+                chunk = data[:self.part_size - self.part_written]
+            self.part_file.write(chunk)
+            self.part_md5.update(chunk)
+            self.part_written += len(chunk)
+            data = data[len(chunk):]
+            if self.part_size is not None and self.part_written >= self.part_size:
+                self.close_part()
+
+    def archive_name(self):
+        name = self.output_prefix
+        if self.compress:
+            name += GZIP_SUFFIX
+        return name
+
+    def open_part(self):
+        filename = self.archive_name()
+        if self.part_size is not None:
+            filename += PART_SUFFIX.format(len(self.parts))
+        self.part_file = open(filename, "wb")
+        self.part_md5 = hashlib.md5()
+        self.part_written = 0
+
+    def close_part(self):
+        self.part_file.close()
+        self.parts.append((self.part_file.name, self.part_md5.hexdigest(), self.part_written))
+        logging.info("Wrote archive {}".format(self.part_file.name))
+        self.part_file = None
+
+    def close(self):
+        if self.compress:
+            if self.block:
+                self.submit(bytes(self.block))
+                self.block = bytearray()
+            while self.pending:
+                self.write_output(self.pending.popleft().result())
+            self.executor.shutdown()
+        if self.part_file is None and not self.parts:
+            self.open_part()
+        if self.part_file is not None:
+            self.close_part()
+
+
+def release_files(directory):
+    '''All the files in directory, in a stable order'''
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        dirs.sort()
+        for filename in sorted(files):
+            yield os.path.join(root, filename)
+
+
+def package_release(directory, output_prefix=None, part_size=None, compress=False, jobs=DEFAULT_PACKAGE_JOBS):
+    '''Stream all the files in directory into a tar archive, writing a
+    manifest of checksums computed on the way. Returns the manifest file name.
+    Member names in the archive are relative to the parent of directory.'''
+    directory = os.path.normpath(directory)
+    if output_prefix is None:
+        output_prefix = directory + TAR_SUFFIX
+    parent = os.path.dirname(directory)
+    writer = ArchiveWriter(output_prefix, part_size, compress, jobs)
+    members = []
+    with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for path in release_files(directory):
+            arcname = os.path.relpath(path, parent)
+            with open(path, "rb") as member_file:
+                info = tar.gettarinfo(arcname=arcname, fileobj=member_file)
+                reader = HashingReader(member_file)
+                tar.addfile(info, reader)
+            members.append((arcname, reader.md5.hexdigest(), reader.size))
+            logging.info("Packaged {}".format(path))
+    writer.close()
+    manifest_filename = output_prefix + MANIFEST_SUFFIX
+    with open(manifest_filename, "w") as manifest:
+        for name, md5, size in members:
+            manifest.write("member\t{}\t{}\t{}\n".format(md5, size, name))
+        manifest.write("archive\t{}\t{}\t{}\n".format(writer.md5.hexdigest(), writer.size,
+            os.path.basename(output_prefix)))
+        for name, md5, size in writer.parts:
+            manifest.write("part\t{}\t{}\t{}\n".format(md5, size, os.path.basename(name)))
+    logging.info("Package manifest written to: {}".format(manifest_filename))
+    return manifest_filename
+
+
+def main():
+    args = parse_args()
+    package_release(args.dir, args.output, args.part_size, args.compress, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,36 +29,86 @@ def make_one_random_id():
 # of this program run at the same time.
 # If the database does not exist we will create a new empty one.
 def make_random_ids(used_ids_database, sample_ids):
-    conn = sqlite3.connect(used_ids_database)
-    cursor = conn.cursor()
-    cursor.execute('CREATE TABLE IF NOT EXISTS unique_ids (id integer)')
-    # The set of IDs that have already been used
-    used_ids = set([])
-    # Grab all the IDs from the database
-    for (next_used_id,) in cursor.execute('SELECT * from unique_ids'):
-        used_ids.add(next_used_id)
-    # The newly generated IDs by the call to this function
-    new_ids = []
-    # A list of pairs containing the original ID and its new randomised ID
-    result = {}
-    for old_sample in sample_ids:
+    return make_random_id_groups(used_ids_database, [sample_ids])[0]
+
+# Allocate randomised IDs for several groups of samples (for example one
+# group per data application) in a single database transaction. The same
+# original sample in two different groups gets two different random IDs, so
+# separate releases cannot be linked together.
+def make_random_id_groups(used_ids_database, sample_id_groups):
+    allocator = RandomIdAllocator(used_ids_database)
+    results = [allocator.randomise(sample_ids) for sample_ids in sample_id_groups]
+    allocator.commit()
+    allocator.close()
+    return results
+
+class RandomIdAllocator(object):
+    '''Hands out new random IDs one at a time, so that callers which
+    discover sample IDs incrementally (e.g. while streaming metadata) can
+    randomise them as they go. New IDs are written to the database by commit.
+
+    A long lived allocator can be shared between threads (check_same_thread
+    False), provided the callers serialise their use of it.'''
+
+    def __init__(self, used_ids_database, check_same_thread=True):
+        self.conn = sqlite3.connect(used_ids_database, check_same_thread=check_same_thread)
+        cursor = self.conn.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS unique_ids (id integer)')
+        # The set of IDs that have already been used
+        self.used_ids = set([])
+        # rowid of the last database row read into used_ids
+        self.last_row = 0
+        # Grab all the IDs from the database
+        self.refresh()
+        # The newly generated IDs not yet written to the database
+        self.new_ids = []
+        # Original ID to randomised ID, for calls to get
+        self.ids = {}
+
+    def refresh(self):
+        '''Read the IDs added to the database since it was last read, for
+        example by other programs while this allocator was open'''
+        cursor = self.conn.cursor()
+        for row, next_used_id in cursor.execute(
+                'SELECT rowid, id from unique_ids WHERE rowid > ? ORDER BY rowid', (self.last_row,)):
+            self.used_ids.add(next_used_id)
+            self.last_row = row
+
+    def new_id(self):
         # Make sure the newly generated ID has not been seen before
         new_id = make_one_random_id()
         iter_count = 0
-        while new_id in used_ids:
+        while new_id in self.used_ids:
             if iter_count >= MAX_RANDOM_ID_ITERATIONS:
                 print_error("Could not make a new random ID, iteration count exceeded")
                 exit(ERROR_RANDOM_ID_ITERATIONS)
             new_id = make_one_random_id()
             iter_count += 1
-        result[old_sample] = new_id
         # Record this new ID in the set of previously used IDs so we don't
         # use it again
-        used_ids.add(new_id)
-        new_ids.append(new_id)
-    # Write the newly created IDs out to the database
-    # XXX should be able to do this as a single INSERT statement
-    for new_id in new_ids:
-        cursor.execute('INSERT into unique_ids (id) VALUES ({})'.format(new_id))
-    conn.commit()
-    return result
+        self.used_ids.add(new_id)
+        self.new_ids.append(new_id)
+        return new_id
+
+    def get(self, old_sample):
+        '''The randomised ID of old_sample, allocating one on first use'''
+        try:
+            return self.ids[old_sample]
+        except KeyError:
+            new_id = self.new_id()
+            self.ids[old_sample] = new_id
+            return new_id
+
+    def randomise(self, sample_ids):
+        '''A fresh dictionary from each original ID to a new randomised ID'''
+        return { old_sample: self.new_id() for old_sample in sample_ids }
+
+    def commit(self):
+        # Write the newly created IDs out to the database
+        self.conn.executemany('INSERT into unique_ids (id) VALUES (?)',
+            [(new_id,) for new_id in self.new_ids])
+        self.conn.commit()
+        self.new_ids = []
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,110 @@
+'''
+Replace read names with short sequential numbers.
+
+Illumina read names carry the instrument, run, flowcell and tile of every
+read, and are a large part of the size of a BAM file. Renumbering replaces
+each distinct name with a number (1, 2, 3 ...) in order of first
+appearance. All the records of a template (both mates, and secondary and
+supplementary alignments) get the same number.
+
+In coordinate sorted input the records of a template are usually close
+together, so a name is only remembered until all of its records have been
+seen. The records expected for a name are counted from its flags and tags:
+
+    - one primary record per segment (two for paired reads)
+    - one supplementary record for each alignment in the SA tag of a primary
+    - NH - 1 secondary records per segment, if primaries have an NH tag
+
+The map also has a limit on its size. If more names than that are waiting
+for records (for example because the input was filtered and some mates are
+missing), the oldest are forgotten, and any records of theirs which appear
+later get a new number. The number of names forgotten this way is logged.
+'''
+
+import logging
+from argparse import ArgumentTypeError
+
+DEFAULT_MAX_READ_NAMES = 1000000
+FLAG_PAIRED = 0x1
+FLAG_SECONDARY = 0x100
+FLAG_SUPPLEMENTARY = 0x800
+
+
+def add_read_name_args(parser):
+    '''Read renumbering options, shared by the programs which call bam_edit'''
+    parser.add_argument("--renumber-reads", required=False, action="store_true",
+        help="Replace BAM read names with short sequential numbers")
+    parser.add_argument("--max-read-names", required=False, type=parse_max_names, default=DEFAULT_MAX_READ_NAMES,
+        help="Most read names remembered while renumbering, at least 1, defaults to {}".format(DEFAULT_MAX_READ_NAMES))
+
+
+def parse_max_names(text):
+    max_names = int(text)
+    if max_names < 1:
+        raise ArgumentTypeError("must be at least 1, not {}".format(max_names))
+    return max_names
+
+
+class ReadName(object):
+    '''The new name of a template, and the records still expected for it'''
+    __slots__ = ('new_name', 'primaries', 'supplementaries', 'secondaries')
+
+    def __init__(self, new_name, segments):
+        self.new_name = new_name
+        self.primaries = segments
+        # expected minus seen, so records may arrive in any order
+        self.supplementaries = 0
+        self.secondaries = 0
+
+    def complete(self):
+        return self.primaries <= 0 and self.supplementaries <= 0 and self.secondaries <= 0
+
+
+class ReadNameMap(object):
+    '''Maps the original read names of a BAM file to sequential numbers'''
+
+    def __init__(self, max_names=DEFAULT_MAX_READ_NAMES):
+        self.max_names = max_names
+        # dictionaries keep insertion order, so the first entry is the oldest
+        self.names = {}
+        self.count = 0
+        self.forgotten = 0
+
+    def rename(self, read):
+        '''The new name for a pysam AlignedSegment'''
+        name = read.query_name
+        entry = self.names.get(name)
+        if entry is None:
+            self.count += 1
+            entry = ReadName(str(self.count), 2 if read.flag & FLAG_PAIRED else 1)
+            self.names[name] = entry
+            if len(self.names) > self.max_names:
+                del self.names[next(iter(self.names))]
+                self.forgotten += 1
+        self.seen(entry, read)
+        if entry.complete():
+            del self.names[name]
+        return entry.new_name
+
+    def seen(self, entry, read):
+        flag = read.flag
+        if flag & FLAG_SUPPLEMENTARY:
+            entry.supplementaries -= 1
+        elif flag & FLAG_SECONDARY:
+            entry.secondaries -= 1
+        else:
+            entry.primaries -= 1
+            if read.has_tag('SA'):
+                entry.supplementaries += len([alignment for alignment in read.get_tag('SA').split(';') if alignment])
+            if read.has_tag('NH'):
+                entry.secondaries += max(read.get_tag('NH') - 1, 0)
+
+    def finish(self):
+        '''Log the names which were incomplete or forgotten'''
+        if self.forgotten:
+            logging.warning("Read renumbering forgot {} names with records still expected, "
+                "raise the limit of {} names to keep all records of a template together".format(
+                self.forgotten, self.max_names))
+        if self.names:
+            logging.info("Read renumbering: {} names were missing some records".format(len(self.names)))
+        logging.info("Renumbered {} read names".format(self.count))
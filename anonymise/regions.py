@@ -0,0 +1,114 @@
+'''
+Restrict a release to the genomic regions of its prioritised genes.
+
+Applications with filter_results TRUE only entitle the researchers to the
+genes listed for each sample in the Prioritised_Genes column of
+samples.txt. Given a BED file of gene coordinates (--gene-bed, with the gene
+name in the fourth column), the BAM and VCF files of such a release contain
+just the records overlapping the sample's genes:
+
+    - BAM files are read with their .bai index, so only the overlapping
+      parts of the file are read, and the output is indexed again
+    - bgzipped VCF files with a tabix index are read the same way; plain
+      text VCF files are filtered as they are read
+
+Regions are BED style: 0-based, half open (chrom, start, end).
+'''
+
+import re
+import bisect
+import logging
+
+GENE_SEPARATOR = re.compile(r'[,;\s]+')
+
+
+def add_region_args(parser):
+    '''Region options, shared by the programs which plan releases'''
+    parser.add_argument("--gene-bed", required=False, type=str,
+        help="BED file of gene regions (name in column 4), used to restrict filtered results applications to their prioritised genes")
+
+
+def read_gene_bed(filename):
+    '''Gene name to a list of (chrom, start, end) regions'''
+    genes = {}
+    with open(filename) as bed_file:
+        for line in bed_file:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 4:
+                continue
+            genes.setdefault(fields[3], []).append((fields[0], int(fields[1]), int(fields[2])))
+    return genes
+
+
+def read_bed(filename):
+    '''The (chrom, start, end) regions of a BED file'''
+    regions = []
+    with open(filename) as bed_file:
+        for line in bed_file:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            regions.append((fields[0], int(fields[1]), int(fields[2])))
+    return regions
+
+
+def parse_genes(text):
+    '''The genes in a Prioritised_Genes value'''
+    return [gene for gene in GENE_SEPARATOR.split(text) if gene]
+
+
+def merge_regions(regions):
+    '''Sorted regions with overlapping and adjacent regions joined'''
+    merged = []
+    for chrom, start, end in sorted(regions):
+        if merged and merged[-1][0] == chrom and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        else:
+            merged.append([chrom, start, end])
+    return [tuple(region) for region in merged]
+
+
+def gene_regions(genes, gene_bed):
+    '''The merged regions of a list of genes'''
+    regions = []
+    for gene in genes:
+        if gene in gene_bed:
+            regions.extend(gene_bed[gene])
+        else:
+            logging.warning("Gene {} is not in the gene BED file".format(gene))
+    return merge_regions(regions)
+
+
+class RegionIndex(object):
+    '''Answers whether positions are inside a list of regions'''
+
+    def __init__(self, regions):
+        self.starts = {}
+        self.ends = {}
+        for chrom, start, end in merge_regions(regions):
+            self.starts.setdefault(chrom, []).append(start)
+            self.ends.setdefault(chrom, []).append(end)
+
+    def contains(self, chrom, position):
+        '''position is 0-based'''
+        starts = self.starts.get(chrom)
+        if starts is None:
+            return False
+        index = bisect.bisect_right(starts, position) - 1
+        return index >= 0 and position < self.ends[chrom][index]
+
+
+def fetch_regions(fetch, regions, start_of):
+    '''Yield the records of each region from fetch(chrom, start, end),
+    once each even if they overlap several regions. Regions must be merged
+    and in the order of the file. start_of gives a record's 0-based start.'''
+    previous = None
+    for chrom, start, end in regions:
+        for record in fetch(chrom, start, end):
+            # records starting in the previous region were written with it
+            if previous is not None and previous[0] == chrom and start_of(record) < previous[2]:
+                continue
+            yield record
+        previous = (chrom, start, end)
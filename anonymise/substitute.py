@@ -0,0 +1,96 @@
+'''
+Replace many identifiers in text at once, for the BAM and VCF editors.
+
+A substitution maps old identifiers (sample IDs, batch IDs, flowcells and
+so on) to their new values. All the old identifiers are compiled into one
+regular expression, so each string is searched once no matter how many
+identifiers there are, and a file with several samples in it (a merged BAM
+or a trio VCF) can be anonymised in a single pass. Where an identifier
+contains another (010108101 and 010108101A) the longest one is replaced.
+
+Values which repeat many times, such as the read group of every record in
+a BAM file, are memoised, so each distinct value is only searched once.
+
+Substitutions can be given on the command line as repeated --old and --new
+pairs, or in a file of tab separated "old new" lines (--map).
+'''
+
+import re
+
+# Bounds the memory used by memoised values. Read groups and similar tags
+# have few distinct values, so this is rarely reached.
+MAX_MEMOISED_VALUES = 100000
+
+
+def add_substitution_args(parser):
+    '''Substitution options, shared by the editors'''
+    parser.add_argument("--old", required=False, action="append", default=[],
+        help="old string (to be replaced), may be repeated with a matching --new")
+    parser.add_argument("--new", required=False, action="append", default=[],
+        help="new string (to replace old), one for each --old")
+    parser.add_argument("--map", required=False, type=str,
+        help="file of tab separated old and new strings, one pair per line")
+
+
+def substitutions_from_args(parser, args):
+    '''The substitution mapping from the --old, --new and --map options'''
+    if len(args.old) != len(args.new):
+        parser.error("each --old needs exactly one --new")
+    substitutions = {}
+    if args.map is not None:
+        substitutions.update(read_substitution_file(args.map))
+    substitutions.update(zip(args.old, args.new))
+    if not substitutions:
+        parser.error("give at least one --old and --new pair, or --map")
+    return substitutions
+
+
+def read_substitution_file(filename):
+    substitutions = {}
+    with open(filename) as map_file:
+        for line in map_file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2 and fields[0]:
+                substitutions[fields[0]] = fields[1]
+    return substitutions
+
+
+class Substitution(object):
+    '''Replace every old identifier in a mapping with its new value'''
+
+    def __init__(self, mapping):
+        self.mapping = { old: new for old, new in mapping.items() if old and old != new }
+        # longest first, so that an identifier which contains another is
+        # replaced in full
+        alternatives = sorted(self.mapping, key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(old) for old in alternatives)) \
+            if alternatives else None
+        self.memo = {}
+
+    def replace(self, text):
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self.new_value, text)
+
+    def new_value(self, match):
+        return self.mapping[match.group()]
+
+    def __call__(self, text):
+        '''Replace, memoising the result for values which repeat'''
+        try:
+            return self.memo[text]
+        except KeyError:
+            pass
+        result = self.replace(text)
+        if len(self.memo) < MAX_MEMOISED_VALUES:
+            self.memo[text] = result
+        return result
+
+
+def as_substitution(substitutions):
+    '''A Substitution for a mapping. An existing Substitution is returned
+    as it is, so that callers editing many files or streams can share its
+    compiled pattern and memoised values.'''
+    if isinstance(substitutions, Substitution):
+        return substitutions
+    return Substitution(substitutions)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+'''
+Upload a release directory to S3 compatible object storage.
+
+Files are uploaded concurrently through a bounded connection pool. Large
+files are sent as multipart uploads with their parts uploaded in parallel,
+and small files with a single request. Symbolic links are followed, so the
+bucket receives the data, not the links.
+
+Uploads are resumable: the upload ID and the parts already sent for each
+file are recorded in a state file next to the release directory
+(APPID/REQID.upload_state.json), separately for each endpoint and bucket.
+Re-running an interrupted upload skips finished files and parts (after
+confirming them with the server), and continues from where it stopped.
+
+The MD5 checksums already computed by anon in the .md5 files are reused:
+they are sent as Content-MD5 for single request uploads, so the server
+verifies the data, and stored as "md5" object metadata for every file.
+Parts of multipart uploads are verified with the MD5 of the part, which
+is computed from the data in memory.
+
+Credentials are read from the usual places (environment variables,
+~/.aws/credentials and so on). The boto3 library is needed for uploading.
+
+Usage:
+
+    upload.py --dir APPID/REQID --bucket releases [--endpoint http://localhost:9000]
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+import os
+import json
+import base64
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from error import print_error, ERROR_UPLOAD
+from package import release_files, parse_size
+
+DEFAULT_UPLOAD_JOBS = 8
+DEFAULT_UPLOAD_PART_SIZE = 64 << 20
+# S3 does not allow parts smaller than this, except the last one
+MIN_UPLOAD_PART_SIZE = 5 << 20
+UPLOAD_STATE_SUFFIX = ".upload_state.json"
+# the destination of uploads to AWS, which have no endpoint URL
+DEFAULT_ENDPOINT_NAME = "aws"
+MD5_SUFFIX = ".md5"
+
+
+def parse_args():
+    """Upload a release directory to S3 compatible object storage"""
+    parser = ArgumentParser(description="Upload a release directory to S3 compatible object storage")
+    parser.add_argument("--dir", required=True, type=str, help="release directory to upload")
+    parser.add_argument("--bucket", required=True, type=str, help="destination bucket")
+    add_upload_args(parser, "")
+    return parser.parse_args()
+
+
+def add_upload_args(parser, prefix):
+    '''Upload options, shared with the programs which call upload_release'''
+    parser.add_argument("--{}prefix".format(prefix), required=False, type=str, default="",
+        help="key prefix (directory) for uploaded objects, defaults to none")
+    parser.add_argument("--{}endpoint".format(prefix), required=False, type=str,
+        help="URL of the S3 compatible endpoint, defaults to AWS")
+    parser.add_argument("--{}jobs".format(prefix), required=False, type=int, default=DEFAULT_UPLOAD_JOBS,
+        help="number of concurrent connections, defaults to {}".format(DEFAULT_UPLOAD_JOBS))
+    parser.add_argument("--{}part-size".format(prefix), required=False, type=parse_size,
+        default=DEFAULT_UPLOAD_PART_SIZE,
+        help="multipart upload part size in bytes (suffixes K, M, G and T are allowed), defaults to {}".format(DEFAULT_UPLOAD_PART_SIZE))
+
+
+def make_client(endpoint_url, jobs):
+    try:
+        import boto3
+        from botocore.config import Config
+    except ImportError:
+        print_error("uploading requires the boto3 library")
+        exit(ERROR_UPLOAD)
+    return boto3.client("s3", endpoint_url=endpoint_url,
+        config=Config(max_pool_connections=jobs))
+
+
+def read_md5_file(filename):
+    '''Return the hex digest stored in an .md5 file, or None if there is no
+    such file. Accepts the output of both "openssl md5" and "md5sum".'''
+    try:
+        with open(filename) as md5_file:
+            text = md5_file.read().strip()
+    except (IOError, OSError):
+        return None
+    if '= ' in text:
+        # openssl md5: MD5(filename)= digest
+        return text.rsplit('= ', 1)[1].strip()
+    elif text:
+        # md5sum: digest  filename
+        return text.split()[0]
+    return None
+
+
+def upload_destination(endpoint_url, bucket):
+    '''The name under which the state of uploads to a bucket is saved'''
+    return "{}/{}".format(endpoint_url or DEFAULT_ENDPOINT_NAME, bucket)
+
+
+class UploadState(object):
+    '''Progress of an upload to one destination (see upload_destination),
+    saved to disk after every finished part so an interrupted upload can be
+    resumed. The file keeps the progress of every destination.'''
+
+    def __init__(self, filename, destination):
+        self.filename = filename
+        self.lock = threading.Lock()
+        try:
+            with open(filename) as state_file:
+                self.destinations = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            self.destinations = {}
+        self.files = self.destinations.setdefault(destination, {})
+
+    def get(self, key, path):
+        '''The saved state for key, or None if there is none or the file has
+        changed since it was saved'''
+        stat = os.stat(path)
+        with self.lock:
+            state = self.files.get(key)
+            if state is None or state['size'] != stat.st_size or state['mtime'] != stat.st_mtime:
+                return None
+            return state
+
+    def start(self, key, path, upload_id):
+        stat = os.stat(path)
+        with self.lock:
+            self.files[key] = { 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'upload_id': upload_id, 'parts': {}, 'complete': False }
+            self.save()
+
+    def add_part(self, key, part_number, etag):
+        with self.lock:
+            self.files[key]['parts'][str(part_number)] = etag
+            self.save()
+
+    def set_parts(self, key, parts):
+        with self.lock:
+            self.files[key]['parts'] = { str(number): etag for number, etag in parts.items() }
+            self.save()
+
+    def finish(self, key):
+        with self.lock:
+            self.files[key]['complete'] = True
+            self.files[key]['upload_id'] = None
+            self.files[key]['parts'] = {}
+            self.save()
+
+    def save(self):
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "w") as state_file:
+            json.dump(self.destinations, state_file, indent=1)
+        os.replace(temp_filename, self.filename)
+
+
+def read_part(path, offset, size):
+    with open(path, "rb") as part_file:
+        part_file.seek(offset)
+        return part_file.read(size)
+
+
+def b64_md5(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+
+class Uploader(object):
+    def __init__(self, client, executor, bucket, state, part_size):
+        self.client = client
+        self.executor = executor
+        self.bucket = bucket
+        self.state = state
+        self.part_size = max(part_size, MIN_UPLOAD_PART_SIZE)
+
+    def upload_file(self, path, key):
+        '''Start uploading path. Returns the futures of the requests that
+        were started, and a function to call once they have all finished
+        (or None if there is nothing more to do).'''
+        state = self.state.get(key, path)
+        if state is not None and state['complete']:
+            logging.info("Already uploaded {} to {}".format(path, key))
+            return [], None
+        md5 = read_md5_file(path + MD5_SUFFIX)
+        metadata = {} if md5 is None else { 'md5': md5 }
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            return [self.executor.submit(self.put_file, path, key, md5, metadata)], None
+        if state is None or state['upload_id'] is None or not self.resume(key, state):
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key, Metadata=metadata)
+            self.state.start(key, path, response['UploadId'])
+            state = self.state.get(key, path)
+        done_parts = state['parts']
+        futures = []
+        for number, offset in enumerate(range(0, size, self.part_size), 1):
+            if str(number) not in done_parts:
+                futures.append(self.executor.submit(self.put_part, path, key,
+                    state['upload_id'], number, offset))
+        return futures, lambda: self.complete(path, key, state['upload_id'])
+
+    def resume(self, key, state):
+        '''Check which parts of an unfinished upload the server already has.
+        Returns False if the upload no longer exists.'''
+        parts = {}
+        try:
+            paginator = self.client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=state['upload_id']):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part['ETag']
+        except self.client.exceptions.NoSuchUpload:
+            return False
+        self.state.set_parts(key, parts)
+        logging.info("Resuming upload of {} with {} parts already uploaded".format(key, len(parts)))
+        return True
+
+    def put_file(self, path, key, md5, metadata):
+        with open(path, "rb") as data:
+            arguments = { 'Bucket': self.bucket, 'Key': key, 'Body': data, 'Metadata': metadata }
+            if md5 is not None:
+                arguments['ContentMD5'] = b64_md5(bytes.fromhex(md5))
+            self.client.put_object(**arguments)
+        self.state.start(key, path, None)
+        self.state.finish(key)
+        logging.info("Uploaded {} to {}".format(path, key))
+
+    def put_part(self, path, key, upload_id, number, offset):
+        data = read_part(path, offset, self.part_size)
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id,
+            PartNumber=number, Body=data, ContentMD5=b64_md5(hashlib.md5(data).digest()))
+        self.state.add_part(key, number, response['ETag'])
+
+    def complete(self, path, key, upload_id):
+        state = self.state.get(key, path)
+        parts = [{ 'PartNumber': int(number), 'ETag': etag }
+            for number, etag in sorted(state['parts'].items(), key=lambda part: int(part[0]))]
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={ 'Parts': parts })
+        self.state.finish(key)
+        logging.info("Uploaded {} to {} in {} parts".format(path, key, len(parts)))
+
+
+def object_key(prefix, relative_path):
+    '''The key of a file uploaded under prefix, e.g. release1/APPID/REQID/FILE'''
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    return prefix + relative_path.replace(os.sep, '/')
+
+
+def upload_release(directory, bucket, prefix="", endpoint_url=None,
+        jobs=DEFAULT_UPLOAD_JOBS, part_size=DEFAULT_UPLOAD_PART_SIZE):
+    '''Upload every file in directory to the bucket. Object keys are the
+    file paths relative to the parent of directory, under prefix (see
+    object_key).'''
+    directory = os.path.normpath(directory)
+    parent = os.path.dirname(directory)
+    client = make_client(endpoint_url, jobs)
+    state = UploadState(directory + UPLOAD_STATE_SUFFIX, upload_destination(endpoint_url, bucket))
+    failure = None
+    with ThreadPoolExecutor(jobs) as executor:
+        uploader = Uploader(client, executor, bucket, state, part_size)
+        # start all the requests, so that the pool is kept busy across files
+        uploads = []
+        try:
+            for path in release_files(directory):
+                uploads.append(uploader.upload_file(path, object_key(prefix, os.path.relpath(path, parent))))
+            for futures, complete in uploads:
+                for future in futures:
+                    future.result()
+                if complete is not None:
+                    complete()
+        except Exception as e:
+            failure = e
+            # only wait for the requests already running, which are saved
+            # in the state to resume from
+            for futures, _complete in uploads:
+                for future in futures:
+                    future.cancel()
+    if failure is not None:
+        print_error("upload of {} failed: {}".format(directory, failure))
+        exit(ERROR_UPLOAD)
+    logging.info("Uploaded {} to bucket {}".format(directory, bucket))
+
+
+def main():
+    args = parse_args()
+    upload_release(args.dir, args.bucket, args.prefix, args.endpoint, args.jobs, args.part_size)
+
+
+if __name__ == '__main__':
+    main()
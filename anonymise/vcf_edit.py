@@ -4,48 +4,148 @@
 Replace text in the header of a VCF file in certain fields for the purposes
 of anonymisation.
 
-Replaces --old with --new in the following places:
+Replaces each --old with the matching --new (or each pair in the --map
+file, see substitute.py) in the following places, in a single pass over the
+file:
 
     - VCF header up until and including the column header line 
 
 We assume that only header lines start with '#'.
 
+With --verify, line counts, header line counts and a checksum of the body
+(which must not change) are compared between input and output as the file
+is written, and reported in output.verify (see verify.py).
+
+With --regions, only the variants inside the regions of a BED file are
+written, see regions.py.
+
+--input and --output may be "-" for standard input and output, so the
+editor can be a stage in a pipe. For in-process pipelines, edit_vcf_lines
+takes and yields lines.
+
 Usage:
 
-    vcf_edit.py --old oldtext --new newtext --input example_input.vcf --output example_output.vcf
+    vcf_edit.py --old oldtext --new newtext [--old oldtext2 --new newtext2 ...] --input example_input.vcf --output example_output.vcf [--verify]
+    vcf_edit.py --map substitutions.tsv --input example_input.vcf --output example_output.vcf [--verify]
+    zcat example_input.vcf.gz | vcf_edit.py --map substitutions.tsv --input - --output - | bgzip > example_output.vcf.gz
 
 Authors: Bernie Pope, Gayle Philip
 
 '''
 
+import os
+import sys
 from argparse import ArgumentParser
+from verify import Verification
+from constants import STANDARD_STREAM
+from substitute import as_substitution, add_substitution_args, substitutions_from_args
+from regions import read_bed, merge_regions, fetch_regions, RegionIndex
+
+TABIX_INDEX_SUFFIXES = [".tbi", ".csi"]
 
 def parse_args():
     """Replace old text with new text in the header of a VCF file"""
     parser = ArgumentParser(description="Replace old text with new text in the header of a VCF file")
-    parser.add_argument("--old", required=True, type=str, help="old string (to be replaced)")
-    parser.add_argument("--new", required=True, type=str, help="new string (to replace old)")
-    parser.add_argument("--output", required=True, type=str, help="output VCF file path")
-    parser.add_argument("--input", required=True, type=str, help="input VCF file path")
-    return parser.parse_args() 
-
-def vcf_edit(old, new, input_filename, output_filename):
-    with open(input_filename) as input_file, \
-         open(output_filename, "w") as output_file:
-        for line in input_file:
-            if line.startswith('#'):
-                # this replaces all occurrences of old with new
-                # on the input line
-                # We assume header lines start with at least one '#'
-                # character.
-                new_line = line.replace(old, new)
-            else:
-                new_line = line
-            output_file.write(new_line)
+    add_substitution_args(parser)
+    parser.add_argument("--output", required=True, type=str,
+        help="output VCF file path, {} for standard output".format(STANDARD_STREAM))
+    parser.add_argument("--input", required=True, type=str,
+        help="input VCF file path, {} for standard input".format(STANDARD_STREAM))
+    parser.add_argument("--regions", type=str,
+        help="BED file of regions, only variants inside them are written")
+    parser.add_argument("--verify", action="store_true", help="verify the output while writing it")
+    parser.add_argument("--verify-report", type=str,
+        help="verification report path, defaults to the output path followed by .verify")
+    args = parser.parse_args()
+    if args.verify and args.output == STANDARD_STREAM and args.verify_report is None:
+        parser.error("--verify with output to {} needs --verify-report".format(STANDARD_STREAM))
+    return args, substitutions_from_args(parser, args)
+
+def vcf_edit(substitutions, input_filename, output_filename, verify=False, verify_report=None, regions=None):
+    '''Replace every old identifier in the substitutions mapping with its
+    new value in the header. Either filename may be "-" for the standard
+    streams. If regions, a list of BED style (chrom, start, end), is given,
+    only the variants inside them are written.'''
+    verification = Verification(input_filename, output_filename, verify_report) if verify else None
+    with open_stream(output_filename, sys.stdout, "w") as output_file:
+        write = output_file.write
+        if verification is not None:
+            write = verification.measure_output(write, measure_line)
+        if regions is None:
+            with open_stream(input_filename, sys.stdin, "r") as input_file:
+                write_vcf_lines(write, input_file, substitutions, verification)
+        else:
+            write_vcf_lines(write, vcf_region_lines(input_filename, regions), substitutions, verification)
+    if verification is not None:
+        verification.finish()
+
+def write_vcf_lines(write, lines, substitutions, verification=None):
+    if verification is not None:
+        lines = verification.measure_input(lines, measure_line)
+    for line in edit_vcf_lines(lines, substitutions):
+        write(line)
+
+def measure_line(line):
+    '''Verification measurements of a line, see verify.py. The body of the
+    file must not change at all.'''
+    if line.startswith('#'):
+        return [('lines', 1), ('header_lines', 1)]
+    return [('lines', 1), ('body', line.encode('utf-8'))]
+
+def vcf_region_lines(input_filename, regions):
+    '''The header lines of a VCF file, followed by the variants whose
+    position is inside regions. A bgzipped file with a tabix index is read
+    only where the regions are, other files are read through.'''
+    if any(os.path.exists(input_filename + suffix) for suffix in TABIX_INDEX_SUFFIXES):
+        import pysam
+        with pysam.TabixFile(input_filename) as tabix:
+            for line in tabix.header:
+                yield line + '\n'
+            contigs = { name: number for number, name in enumerate(tabix.contigs) }
+            in_file = [region for region in merge_regions(regions) if region[0] in contigs]
+            in_file.sort(key=lambda region: (contigs[region[0]], region[1]))
+            for line in fetch_regions(tabix.fetch, in_file, variant_start):
+                yield line + '\n'
+    else:
+        index = RegionIndex(regions)
+        with open_stream(input_filename, sys.stdin, "r") as input_file:
+            for line in input_file:
+                if line.startswith('#'):
+                    yield line
+                else:
+                    fields = line.split('\t', 2)
+                    if len(fields) > 1 and index.contains(fields[0], variant_start(line)):
+                        yield line
+
+def variant_start(line):
+    '''The 0-based position of a VCF line'''
+    return int(line.split('\t', 2)[1]) - 1
+
+def edit_vcf_lines(lines, substitutions):
+    '''Apply the substitutions to the header of the VCF lines, yielding
+    each line once edited'''
+    substitute = as_substitution(substitutions)
+    for line in lines:
+        if line.startswith('#'):
+            # this replaces all occurrences of every old identifier
+            # on the input line
+            # We assume header lines start with at least one '#'
+            # character.
+            yield substitute.replace(line)
+        else:
+            yield line
+
+def open_stream(filename, standard_stream, mode):
+    '''Open filename, or return standard_stream for "-". The standard
+    stream is not closed when the result is.'''
+    if filename == STANDARD_STREAM:
+        return open(standard_stream.fileno(), mode, closefd=False)
+    return open(filename, mode)
 
 def main():
-    args = parse_args()
-    vcf_edit(args.old, args.new, args.input, args.output)
+    args, substitutions = parse_args()
+    regions = None if args.regions is None else read_bed(args.regions)
+    vcf_edit(substitutions, args.input, args.output, args.verify, args.verify_report, regions)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,116 @@
+'''
+Verification of anonymised outputs, recorded while they are written.
+
+The editors count the records they read, before any editing, and the
+records they pass to the output writer, and checksum the parts of each
+record which anonymisation must not change on both sides. Because this
+happens as the data passes through, checking the output costs no extra
+I/O. The results are written to a report next to the output file:
+
+    example.bam.verify
+
+with one tab separated "name value" line per measurement, followed by a
+"status PASS" or "status FAIL" line.
+'''
+
+import hashlib
+import logging
+
+VERIFY_SUFFIX = ".verify"
+# sides of a measurement
+INPUT = 0
+OUTPUT = 1
+
+
+class VerificationError(Exception):
+    pass
+
+
+class Verification(object):
+    '''Counts and checksums of an editor's input and output. Each measurement
+    has an input and an output value, which must be equal.'''
+
+    def __init__(self, input_filename, output_filename, report_filename=None):
+        self.input_filename = input_filename
+        self.output_filename = output_filename
+        if report_filename is None:
+            report_filename = output_filename + VERIFY_SUFFIX
+        self.report_filename = report_filename
+        # measurement name -> [input value, output value]
+        self.counts = {}
+        self.digests = {}
+
+    def count(self, name, input_value, output_value):
+        '''Add to a counted measurement, e.g. records or header lines'''
+        counts = self.counts.setdefault(name, [0, 0])
+        counts[0] += input_value
+        counts[1] += output_value
+
+    def digest_input(self, name, data):
+        self.digest(name)[0].update(data)
+
+    def digest_output(self, name, data):
+        self.digest(name)[1].update(data)
+
+    def digest(self, name):
+        if name not in self.digests:
+            self.digests[name] = [hashlib.md5(), hashlib.md5()]
+        return self.digests[name]
+
+    def measure_input(self, records, measure):
+        '''Yield records unchanged, adding measure(record) to the input side
+        as each one is read, before it is edited. measure returns a list of
+        (name, value) pairs: numbers are counted, bytes are checksummed.'''
+        for record in records:
+            self.add(INPUT, measure(record))
+            yield record
+
+    def measure_output(self, write, measure):
+        '''Wrap write(record), adding measure(record) to the output side for
+        every record written'''
+        def measured_write(record):
+            self.add(OUTPUT, measure(record))
+            return write(record)
+        return measured_write
+
+    def add(self, side, measurements):
+        for name, value in measurements:
+            if isinstance(value, bytes):
+                self.digest(name)[side].update(value)
+            else:
+                self.counts.setdefault(name, [0, 0])[side] += value
+
+    def results(self):
+        '''(name, input value, output value) for every measurement'''
+        results = [(name, input_value, output_value)
+            for name, (input_value, output_value) in sorted(self.counts.items())]
+        results.extend((name, input_digest.hexdigest(), output_digest.hexdigest())
+            for name, (input_digest, output_digest) in sorted(self.digests.items()))
+        return results
+
+    def passed(self):
+        return all(input_value == output_value for _name, input_value, output_value in self.results())
+
+    def write(self, report_filename=None):
+        if report_filename is None:
+            report_filename = self.report_filename
+        with open(report_filename, "w") as report:
+            # the input file name is not written, because it may contain
+            # the identifiers the output was anonymised to remove
+            report.write("output\t{}\n".format(self.output_filename))
+            for name, input_value, output_value in self.results():
+                report.write("{}_in\t{}\n".format(name, input_value))
+                report.write("{}_out\t{}\n".format(name, output_value))
+            report.write("status\t{}\n".format("PASS" if self.passed() else "FAIL"))
+        return report_filename
+
+    def finish(self):
+        '''Write the report, and raise VerificationError if any check failed'''
+        report_filename = self.write()
+        if self.passed():
+            logging.info("Verified {}, report in {}".format(self.output_filename, report_filename))
+        else:
+            failed = [name for name, input_value, output_value in self.results()
+                if input_value != output_value]
+            raise VerificationError("verification of {} failed for: {}, see {}".format(
+                self.output_filename, ' '.join(failed), report_filename))
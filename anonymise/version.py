@@ -1,3 +1,6 @@
-import pkg_resources  # part of setuptools
+from importlib.metadata import version, PackageNotFoundError
 
-program_version = pkg_resources.require("anonymise")[0].version
+try:
+    program_version = version("anonymise")
+except PackageNotFoundError:
+    program_version = "unknown"
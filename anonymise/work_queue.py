@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+
+'''
+Run the file jobs of a release on many hosts, through a work queue
+directory on shared storage.
+
+anon.py --queue DIR writes each file job (one output file, see FileJob in
+anon.py) to the queue as a JSON file, and waits for workers to run them.
+Workers (this program) can be started on any number of hosts which see the
+same storage, and each runs one job at a time:
+
+    DIR/pending/NAME.json                  waiting to be run
+    DIR/running/NAME.json@WORKER@TIME      claimed by WORKER at TIME
+    DIR/done/NAME.json                     finished
+    DIR/failed/NAME.json                   failed, with the error
+
+A job is claimed by renaming it from pending to running, which is atomic,
+so exactly one worker gets it. While it runs, the worker touches its claim
+file regularly (a heartbeat). A claim which has not been touched for the
+timeout was abandoned (the worker or its host died), and is renamed back to
+pending by the coordinator or any worker, to be run again.
+
+A re-queued job may still be running on its first worker (for example on a
+stalled mount), so workers write their outputs to paths specific to their
+claim (.FILENAME@WORKER@TIME next to the output), and move them into place
+only when they finish while still holding the claim. A worker whose job was
+re-queued deletes its outputs instead.
+
+Workers also compute the MD5 checksum of each output. Once every job is
+done the coordinator (anon.py) checks that every output has a current
+checksum file, and carries on with the leak scan, packaging and upload.
+
+Paths in jobs are absolute, so the queue, the production data and the
+output directory must be at the same paths on every host.
+
+Usage:
+
+    work_queue.py --queue /shared/queue [--exit-when-empty]
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from argparse import ArgumentParser
+from error import print_error, error_name, ERROR_QUEUE
+from verify import VERIFY_SUFFIX
+
+DEFAULT_QUEUE_TIMEOUT = 300
+DEFAULT_HEARTBEAT = 30
+DEFAULT_POLL = 2
+DEFAULT_QUEUE_WAIT = 3600
+PENDING_DIR = "pending"
+RUNNING_DIR = "running"
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+QUEUE_DIRS = [PENDING_DIR, RUNNING_DIR, DONE_DIR, FAILED_DIR]
+JOB_SUFFIX = ".json"
+# separates the job name, the worker and the claim time in a claim file name
+CLAIM_SEPARATOR = "@"
+
+
+def parse_args():
+    """Run file jobs from a shared work queue directory"""
+    parser = ArgumentParser(description="Run anonymisation file jobs from a shared work queue directory")
+    parser.add_argument("--queue", required=True, type=str, help="work queue directory")
+    parser.add_argument("--timeout", required=False, type=float, default=DEFAULT_QUEUE_TIMEOUT,
+        help="seconds without a heartbeat after which a job is re-queued, defaults to {}".format(DEFAULT_QUEUE_TIMEOUT))
+    parser.add_argument("--heartbeat", required=False, type=float, default=DEFAULT_HEARTBEAT,
+        help="seconds between heartbeats, must be well below the timeout, defaults to {}".format(DEFAULT_HEARTBEAT))
+    parser.add_argument("--poll", required=False, type=float, default=DEFAULT_POLL,
+        help="seconds between checks for new jobs, defaults to {}".format(DEFAULT_POLL))
+    parser.add_argument("--exit-when-empty", required=False, action="store_true",
+        help="exit when there are no pending or running jobs, instead of waiting for more")
+    parser.add_argument('--log', metavar='FILE', type=str,
+        help='Log progress in FILENAME, defaults to stdout')
+    return parser.parse_args()
+
+
+def editors():
+    '''The editors jobs may name, imported when first needed'''
+    from bam_edit import bam_edit
+    from vcf_edit import vcf_edit
+    return { 'bam_edit': bam_edit, 'vcf_edit': vcf_edit }
+
+
+class WorkQueue(object):
+    '''A work queue directory, shared by the coordinator and the workers'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in QUEUE_DIRS:
+            os.makedirs(self.path(name), exist_ok=True)
+
+    def path(self, state, filename=''):
+        return os.path.join(self.directory, state, filename)
+
+    def listdir(self, state):
+        return sorted(os.listdir(self.path(state)))
+
+    def add(self, name, job):
+        '''Add a job, which appears in pending only once it is complete'''
+        temp_filename = os.path.join(self.directory, '.' + name)
+        with open(temp_filename, 'w') as job_file:
+            json.dump(job, job_file)
+        os.rename(temp_filename, self.path(PENDING_DIR, name))
+
+    def claim(self, worker):
+        '''Claim a pending job, returning (name, claim file name, job) or
+        None if there are none'''
+        for name in self.listdir(PENDING_DIR):
+            claim = CLAIM_SEPARATOR.join([name, worker, "{:.3f}".format(time.time())])
+            try:
+                os.rename(self.path(PENDING_DIR, name), self.path(RUNNING_DIR, claim))
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+            with open(self.path(RUNNING_DIR, claim)) as job_file:
+                return name, claim, json.load(job_file)
+        return None
+
+    def heartbeat(self, claim):
+        '''Returns False if the claim is no longer held'''
+        try:
+            os.utime(self.path(RUNNING_DIR, claim))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def finish(self, name, claim, job, state, files=()):
+        '''Record the job as done or failed, first moving the files it wrote
+        to claim specific paths into place, given as (private, final) pairs.
+        Returns False, without moving any files, if the claim was lost
+        because the job was re-queued. The claim is touched first, so it
+        cannot be re-queued for the timeout, far longer than the renames
+        take.'''
+        if not self.heartbeat(claim):
+            return False
+        for private, final in files:
+            os.replace(private, final)
+        # the claim is replaced with the finished job, so it is complete
+        # when it appears in state
+        temp_filename = os.path.join(self.directory, '.' + claim)
+        with open(temp_filename, 'w') as job_file:
+            json.dump(job, job_file)
+        os.replace(temp_filename, self.path(RUNNING_DIR, claim))
+        try:
+            os.rename(self.path(RUNNING_DIR, claim), self.path(state, name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def requeue_abandoned(self, timeout):
+        '''Move claims without a heartbeat for timeout seconds back to
+        pending. Returns the names of the re-queued jobs.'''
+        requeued = []
+        now = time.time()
+        for claim in self.listdir(RUNNING_DIR):
+            name, worker, claimed = claim.split(CLAIM_SEPARATOR)
+            try:
+                alive = max(float(claimed), os.stat(self.path(RUNNING_DIR, claim)).st_mtime)
+            except FileNotFoundError:
+                continue
+            if now - alive < timeout:
+                continue
+            try:
+                os.rename(self.path(RUNNING_DIR, claim), self.path(PENDING_DIR, name))
+            except FileNotFoundError:
+                continue
+            logging.warning("Re-queued job {}, abandoned by {}".format(name, worker))
+            requeued.append(name)
+        return requeued
+
+    def states(self, names):
+        '''The state of each named job: pending, running, done or failed'''
+        states = {}
+        for state in QUEUE_DIRS:
+            for filename in self.listdir(state):
+                name = filename.split(CLAIM_SEPARATOR)[0]
+                if name in names:
+                    states[name] = state
+        return states
+
+    def read(self, state, name):
+        with open(self.path(state, name)) as job_file:
+            return json.load(job_file)
+
+
+def job_to_json(job, md5_command):
+    '''A FileJob (see anon.py) as a JSON serialisable dictionary'''
+    return { 'editor': None if job.editor is None else job.editor.__name__,
+        'substitutions': job.substitutions, 'input': os.path.abspath(job.input),
+        'output': os.path.abspath(job.output), 'materialise': job.materialise,
+        'editor_options': job.editor_options, 'md5': md5_command }
+
+
+def job_from_json(job):
+    from anon import FileJob
+    editor = None if job['editor'] is None else editors()[job['editor']]
+    return FileJob(editor, job['substitutions'], job['input'], job['output'],
+        job['materialise'], job['editor_options'])
+
+
+def private_path(path, claim):
+    '''The path a claim writes in place of path'''
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, ".{}{}{}".format(filename, CLAIM_SEPARATOR,
+        claim.split(CLAIM_SEPARATOR, 1)[1]))
+
+
+def private_job(file_job, claim):
+    '''A FileJob writing to paths specific to a claim, and the (private,
+    final) pairs of the files it writes'''
+    output = private_path(file_job.output, claim)
+    options = dict(file_job.editor_options)
+    files = [(output, file_job.output)]
+    if options.get('index_filename') is not None:
+        files.append((private_path(options['index_filename'], claim), options['index_filename']))
+        options['index_filename'] = files[-1][0]
+    return file_job._replace(output=output, editor_options=options), files
+
+
+def replace_path(filename, private, final):
+    '''Replace a private path with its final path in a small text file,
+    such as a checksum or a verification report'''
+    with open(filename) as text_file:
+        text = text_file.read()
+    with open(filename, 'w') as text_file:
+        text_file.write(text.replace(private, final))
+
+
+def run_job(file_job, files, md5_command):
+    '''Run a private job (see private_job) and checksum the files it
+    writes. The checksum files and verification report are added to files
+    as they are written.'''
+    from anon import run_file_job, md5_file
+    run_file_job(file_job)
+    output, final_output = files[0]
+    if file_job.editor_options.get('verify'):
+        replace_path(output + VERIFY_SUFFIX, output, final_output)
+        files.append((output + VERIFY_SUFFIX, final_output + VERIFY_SUFFIX))
+    for private, final in list(files):
+        if private.endswith(VERIFY_SUFFIX):
+            continue
+        md5_filename = md5_file(md5_command, private)
+        replace_path(md5_filename, private, final)
+        files.append((md5_filename, final + md5_filename[len(private):]))
+
+
+def remove_files(files):
+    for private, _final in files:
+        if os.path.lexists(private):
+            os.remove(private)
+
+
+def worker_name():
+    return "{}.{}".format(socket.gethostname(), os.getpid())
+
+
+class Heartbeat(threading.Thread):
+    '''Touches a claim file until stopped, or until the claim is lost'''
+
+    def __init__(self, queue, claim, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.queue = queue
+        self.claim = claim
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.queue.heartbeat(self.claim):
+                logging.warning("Lost the claim on {}".format(self.claim))
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def work(queue, timeout=DEFAULT_QUEUE_TIMEOUT, heartbeat=DEFAULT_HEARTBEAT, poll=DEFAULT_POLL,
+        exit_when_empty=False):
+    '''Run jobs from the queue until it is empty (if exit_when_empty) or
+    forever'''
+    worker = worker_name()
+    logging.info("Worker {} started on queue {}".format(worker, queue.directory))
+    while True:
+        queue.requeue_abandoned(timeout)
+        claimed = queue.claim(worker)
+        if claimed is None:
+            if exit_when_empty and not queue.listdir(RUNNING_DIR):
+                break
+            time.sleep(poll)
+            continue
+        name, claim, job = claimed
+        logging.info("Running job {}".format(name))
+        beat = Heartbeat(queue, claim, heartbeat)
+        beat.start()
+        start = time.time()
+        state = DONE_DIR
+        files = []
+        try:
+            file_job, files = private_job(job_from_json(job), claim)
+            run_job(file_job, files, job['md5'])
+        except SystemExit as e:
+            # the jobs report errors as anon.py does, by exiting
+            job['error'] = error_name(e.code)
+            state = FAILED_DIR
+        except Exception as e:
+            logging.exception("Job {} failed".format(name))
+            job['error'] = str(e)
+            state = FAILED_DIR
+        finally:
+            beat.stop()
+        job['worker'] = worker
+        job['seconds'] = time.time() - start
+        finished = not beat.lost and queue.finish(name, claim, job, state,
+            files if state == DONE_DIR else [])
+        if not finished or state == FAILED_DIR:
+            remove_files(files)
+        if not finished:
+            logging.warning("Job {} was re-queued while running, result discarded".format(name))
+        else:
+            logging.info("Job {} {} in {:.1f}s".format(name, state, job['seconds']))
+    logging.info("Worker {} finished, queue is empty".format(worker))
+
+
+def run_queued_jobs(directory, jobs, md5_command, timeout=DEFAULT_QUEUE_TIMEOUT, poll=DEFAULT_POLL,
+        wait=DEFAULT_QUEUE_WAIT):
+    '''Coordinate running jobs (FileJobs, see anon.py) on the workers of a
+    queue: add them, wait for them all to finish, re-queuing any which are
+    abandoned, and exit the program if any failed, or if for wait seconds
+    none were running and none finished (there are no workers)'''
+    queue = WorkQueue(directory)
+    prefix = "{}-{}-{}".format(socket.gethostname(), os.getpid(), int(time.time()))
+    names = set()
+    for number, job in enumerate(jobs):
+        name = "{}-{:06d}{}".format(prefix, number, JOB_SUFFIX)
+        queue.add(name, job_to_json(job, md5_command))
+        names.add(name)
+    logging.info("Queued {} jobs in {}".format(len(names), directory))
+    last_progress = None
+    last_active = time.time()
+    while True:
+        queue.requeue_abandoned(timeout)
+        states = queue.states(names)
+        counts = { state: 0 for state in QUEUE_DIRS }
+        for state in states.values():
+            counts[state] += 1
+        progress = tuple(counts[state] for state in QUEUE_DIRS)
+        if progress != last_progress:
+            logging.info("Queued jobs: " + ', '.join("{} {}".format(counts[state], state) for state in QUEUE_DIRS))
+            last_progress = progress
+            last_active = time.time()
+        if counts[DONE_DIR] + counts[FAILED_DIR] == len(names):
+            break
+        # running claims without a heartbeat were re-queued above
+        if counts[RUNNING_DIR] > 0:
+            last_active = time.time()
+        elif time.time() - last_active >= wait:
+            print_error("no queued jobs were run for {:.0f} seconds, are any workers (work_queue.py) running on {}?".format(
+                wait, directory))
+            exit(ERROR_QUEUE)
+        time.sleep(poll)
+    failed = sorted(name for name, state in states.items() if state == FAILED_DIR)
+    for name in failed:
+        job = queue.read(FAILED_DIR, name)
+        print_error("queued job {} for {} failed on {}: {}".format(name, job['output'], job['worker'], job['error']))
+    if failed:
+        exit(ERROR_QUEUE)
+
+
+def main():
+    args = parse_args()
+    from anon import init_log
+    init_log(args.log)
+    work(WorkQueue(args.queue), args.timeout, args.heartbeat, args.poll, args.exit_when_empty)
+
+
+if __name__ == '__main__':
+    main()
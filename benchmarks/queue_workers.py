@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+'''
+Work queue benchmark for the anonymise programs, with several local workers.
+
+Writes synthetic VCF files, queues a VCF edit job for each, and runs them
+with work_queue.py workers in separate processes, coordinated as anon.py
+--queue does. One worker is stopped (SIGSTOP) while it holds a claim, as if
+its host or mount had stalled, until its job has been re-queued and run by
+another worker, and then continued. Reports the time taken, and fails (exit
+status 1) unless:
+
+    - every job finished, and the stalled worker discarded its result
+    - every output has the expected content and a matching .md5 file
+    - no claim specific (private) files are left behind
+
+Usage:
+
+    python benchmarks/queue_workers.py [--workers 4] [--files 12] [--lines 200000]
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+from __future__ import print_function
+import os
+import sys
+import time
+import signal
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+import subprocess
+from argparse import ArgumentParser
+
+DEFAULT_WORKERS = 4
+DEFAULT_FILES = 12
+DEFAULT_LINES = 200000
+# short, so that the stalled worker's job is re-queued quickly
+TIMEOUT = 2.0
+HEARTBEAT = 0.2
+POLL = 0.1
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'anonymise')
+sys.path.insert(0, SOURCE_DIR)
+
+from anon import FileJob, DEFAULT_MD5_COMMAND
+from vcf_edit import vcf_edit
+from upload import read_md5_file
+from work_queue import WorkQueue, run_queued_jobs, RUNNING_DIR, CLAIM_SEPARATOR
+
+
+def parse_args():
+    parser = ArgumentParser(description="Run file jobs on several local work queue workers, one of them stalling")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+        help="number of worker processes, defaults to {}".format(DEFAULT_WORKERS))
+    parser.add_argument("--files", type=int, default=DEFAULT_FILES,
+        help="number of VCF files to edit, defaults to {}".format(DEFAULT_FILES))
+    parser.add_argument("--lines", type=int, default=DEFAULT_LINES,
+        help="variant lines in each VCF file, defaults to {}".format(DEFAULT_LINES))
+    return parser.parse_args()
+
+
+def write_vcf(filename, sample, lines):
+    with open(filename, 'w') as vcf_file:
+        vcf_file.write("##fileformat=VCFv4.2\n")
+        vcf_file.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{}\n".format(sample))
+        for position in range(1, lines + 1):
+            vcf_file.write("chr1\t{}\t.\tA\tG\t50\tPASS\t.\tGT\t0/1\n".format(position))
+
+
+def expected_md5(filename, sample, new_sample):
+    '''The MD5 of the edited VCF, computed from the input'''
+    digest = hashlib.md5()
+    with open(filename) as vcf_file:
+        for line in vcf_file:
+            if line.startswith('#'):
+                line = line.replace(sample, new_sample)
+            digest.update(line.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def start_worker(queue_dir, log_filename):
+    return subprocess.Popen([sys.executable, os.path.join(SOURCE_DIR, 'work_queue.py'),
+        '--queue', queue_dir, '--exit-when-empty', '--timeout', str(TIMEOUT),
+        '--heartbeat', str(HEARTBEAT), '--poll', str(POLL), '--log', log_filename])
+
+
+class Staller(threading.Thread):
+    '''Stops a worker once it holds a claim, and continues it once the claim
+    has been re-queued and run elsewhere'''
+
+    def __init__(self, queue, worker):
+        threading.Thread.__init__(self, daemon=True)
+        self.queue = queue
+        self.worker = worker
+        self.stalled_claim = None
+
+    def run(self):
+        # claims are named JOB@HOST.PID@TIME
+        marker = "{}{}.{}{}".format(CLAIM_SEPARATOR, socket.gethostname(), self.worker.pid, CLAIM_SEPARATOR)
+        while self.worker.poll() is None:
+            for claim in self.queue.listdir(RUNNING_DIR):
+                if marker in claim:
+                    os.kill(self.worker.pid, signal.SIGSTOP)
+                    self.stalled_claim = claim
+                    # wait for the claim to be re-queued (renamed away)
+                    while os.path.exists(self.queue.path(RUNNING_DIR, claim)):
+                        time.sleep(POLL)
+                    time.sleep(TIMEOUT)
+                    os.kill(self.worker.pid, signal.SIGCONT)
+                    return
+            time.sleep(POLL / 10)
+
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="queue_workers.")
+    input_dir = os.path.join(work_dir, "input")
+    output_dir = os.path.join(work_dir, "output")
+    queue_dir = os.path.join(work_dir, "queue")
+    for directory in [input_dir, output_dir]:
+        os.makedirs(directory)
+    jobs = []
+    expected = {}
+    for number in range(args.files):
+        sample = "{:09d}".format(number + 1)
+        new_sample = "R{:09d}".format(number + 1)
+        input_filename = os.path.join(input_dir, sample + ".vcf")
+        output_filename = os.path.join(output_dir, new_sample + ".vcf")
+        write_vcf(input_filename, sample, args.lines)
+        expected[output_filename] = expected_md5(input_filename, sample, new_sample)
+        jobs.append(FileJob(vcf_edit, { sample: new_sample }, input_filename, output_filename,
+            None, { 'verify': True }))
+
+    queue = WorkQueue(queue_dir)
+    start = time.time()
+    workers = [start_worker(queue_dir, os.path.join(work_dir, "worker{}.log".format(number)))
+        for number in range(args.workers)]
+    staller = Staller(queue, workers[0])
+    staller.start()
+    failed = False
+    try:
+        run_queued_jobs(queue_dir, jobs, DEFAULT_MD5_COMMAND, timeout=TIMEOUT, poll=POLL)
+    except SystemExit:
+        print("FAIL: queued jobs failed")
+        failed = True
+    elapsed = time.time() - start
+    staller.join()
+    for worker in workers:
+        worker.wait()
+    print("{} jobs on {} workers: {:.2f}s".format(len(jobs), len(workers), elapsed))
+
+    if staller.stalled_claim is None:
+        print("FAIL: no worker was stalled while holding a claim")
+        failed = True
+    with open(os.path.join(work_dir, "worker0.log")) as log_file:
+        if staller.stalled_claim is not None and "result discarded" not in log_file.read():
+            print("FAIL: the stalled worker did not discard its result")
+            failed = True
+    for filename, digest in sorted(expected.items()):
+        with open(filename, 'rb') as output_file:
+            if hashlib.md5(output_file.read()).hexdigest() != digest:
+                print("FAIL: wrong content in {}".format(filename))
+                failed = True
+        if read_md5_file(filename + ".md5") != digest:
+            print("FAIL: wrong checksum file for {}".format(filename))
+            failed = True
+        if not os.path.exists(filename + ".verify"):
+            print("FAIL: no verification report for {}".format(filename))
+            failed = True
+    private = [filename for filename in os.listdir(output_dir) if CLAIM_SEPARATOR in filename]
+    if private:
+        print("FAIL: private files left behind: {}".format(' '.join(sorted(private))))
+        failed = True
+    if failed:
+        print("Work directory kept: {}".format(work_dir))
+    else:
+        shutil.rmtree(work_dir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+'''
+Startup time benchmark for the anonymise programs.
+
+Imports the command line modules in fresh interpreters several times and
+reports the fastest and median wall clock times. Fails (exit status 1) if
+the median is above --max-seconds, or if importing the programs loads any
+of the slow modules which should only be imported by the stage that needs
+them.
+
+Usage:
+
+    python benchmarks/startup.py [--runs 10] [--max-seconds 0.25]
+
+Authors: Bernie Pope, Gayle Philip
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+
+DEFAULT_RUNS = 10
+DEFAULT_MAX_SECONDS = 0.25
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'anonymise')
+PROGRAM_MODULES = ['anon', 'batch', 'daemon', 'bam_edit', 'vcf_edit']
+# Modules which are slow to import and must be loaded lazily
+SLOW_MODULES = ['pysam', 'jsonschema', 'pkg_resources']
+
+# Run in a fresh interpreter, so that nothing is already imported
+TIMED_IMPORT = '''
+import sys, time, json
+start = time.perf_counter()
+sys.path.insert(0, {source_dir!r})
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed,
+    'slow_modules': [m for m in {slow!r} if m in sys.modules]}}))
+'''
+
+
+def parse_args():
+    parser = ArgumentParser(description="Measure the startup time of the anonymise programs")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS,
+        help="number of interpreters to start, defaults to {}".format(DEFAULT_RUNS))
+    parser.add_argument("--max-seconds", type=float, default=DEFAULT_MAX_SECONDS,
+        help="fail if the median import time is above this, defaults to {}".format(DEFAULT_MAX_SECONDS))
+    return parser.parse_args()
+
+
+def timed_import():
+    code = TIMED_IMPORT.format(source_dir=SOURCE_DIR, modules=PROGRAM_MODULES, slow=SLOW_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output.decode('utf-8'))
+
+
+def main():
+    args = parse_args()
+    results = [timed_import() for _ in range(args.runs)]
+    times = sorted(result['seconds'] for result in results)
+    median = times[len(times) // 2]
+    print("import {}: min {:.3f}s median {:.3f}s over {} runs".format(
+        ' '.join(PROGRAM_MODULES), times[0], median, len(times)))
+    slow_modules = sorted({ module for result in results for module in result['slow_modules'] })
+    failed = False
+    if slow_modules:
+        print("FAIL: slow modules imported at startup: {}".format(' '.join(slow_modules)))
+        failed = True
+    if median > args.max_seconds:
+        print("FAIL: median startup time is above {:.3f}s".format(args.max_seconds))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
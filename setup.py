@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='anonymise',
@@ -11,15 +11,19 @@ setup(
     package_dir={'anonymise': 'anonymise'},
     package_data={'anonymise': ['data/application_json_schema.txt']},
     entry_points={
-        'console_scripts': ['anonymise = anonymise.anon:main']
+        'console_scripts': ['anonymise = anonymise.anon:main',
+                            'anonymise_batch = anonymise.batch:main',
+                            'anonymise_daemon = anonymise.daemon:main',
+                            'anonymise_worker = anonymise.work_queue:main']
     },
     url='https://github.com/bjpop/anonymise',
     license='LICENSE.txt',
     description=( 'Anonymise data'),
     long_description=('Anonymise data'),
+    python_requires=">=3.9",
     install_requires=[
-        "jsonschema == 2.5.1",
-        "functools32",
-        "pysam"
+        "jsonschema >= 2.5.1",
+        "pysam",
+        "pyahocorasick"
     ],
 )